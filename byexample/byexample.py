@@ -1,46 +1,216 @@
 from __future__ import unicode_literals
-from .cache import RegexCache
-from .jobs import Jobs, Status, allow_sigint
-import os, sys
+from .cache import cache_from_env, CACHE_NAME
+from .jobs import Jobs, Admission, Status, allow_sigint, plan_jobs
+from .history import History
+from .shard import Shard, ShardReport
+from .incremental import ResultStore, environment_signature, skip_cached
+from .parse_cache import ParseCache, parse_signature
+from . import __version__
+import os, sys, gc, threading, contextlib
 
-def execute_examples(filename, sigint_handler):
-    global cache, harvester, executor, options, human_args, dry
+# the harvester and the executor of the current slot (see setup_slot)
+_slot = threading.local()
+slots = []
+
+def current_slot():
+    ''' Return the harvester and the executor of the current slot
+        or the global ones if the worker has no slots. '''
+    global harvester, executor
+    return getattr(_slot, 'harvester', harvester), \
+            getattr(_slot, 'executor', executor)
+
+def setup_slot(number):
+    ''' Give to the slot <number> of a worker its own harvester and
+        executor (see slotted_worker); the first slot uses the global
+        ones.
+
+        Return False if this failed so the slot is not used.
+        '''
+    global harvester, executor, new_slot, human_args
     from .common import human_exceptions
 
+    if number == 0:
+        slot_harvester, slot_executor = harvester, executor
+    else:
+        with human_exceptions("While setting up the slot %i:" % number, *human_args) as exc:
+            slot_harvester, slot_executor = new_slot()
+            slot_harvester.parse_cache = harvester.parse_cache
+            slot_harvester.warm_up()
+            slot_executor.cancelled = executor.cancelled
+
+        if exc:
+            return False
+
+    _slot.harvester, _slot.executor = slot_harvester, slot_executor
+    slots.append(slot_executor)
+    return True
+
+@contextlib.contextmanager
+def cache_synced(label):
+    ''' Sync the cache after processing a file unless we are in a
+        slot: the slots of a worker share the cache and it is synced
+        once by teardown_worker. '''
+    global cache
+    if hasattr(_slot, 'executor'):
+        yield
+    else:
+        with cache.synced(label=label):
+            yield
+
+def execute_examples(item, sigint_handler):
+    global cache, options, human_args, dry
+    from .common import human_exceptions
+
+    harvester, executor = current_slot()
+
+    # the item to process is a file or a shard of it
+    filename = str(item)
     with human_exceptions("File '%s':" % filename, *human_args) as exc, \
-            cache.synced(label=filename), \
+            cache_synced(filename), \
             allow_sigint(sigint_handler):
-        examples = harvester.get_examples_from_file(filename)
+        if isinstance(item, Shard):
+            filepath, shard = item.filepath, item
+        else:
+            filepath, shard = filename, None
+
+        examples = harvester.get_examples_from_file(filepath, shard=shard)
+
         if dry:
-            return executor.dry_execute(examples, filename)
+            result = executor.dry_execute(examples, filename)
         else:
-            return executor.execute(examples, filename)
+            result = executor.execute(examples, filename)
+
+        harvester.record_parsed(filepath, shard)
+        return result
 
     user_aborted = isinstance(exc.get('exc'), KeyboardInterrupt)
     error = not user_aborted
     return True, True, user_aborted, error
 
+def languages_of(items):
+    ''' Return a function that returns the languages used by each of
+        the <items> (files or shards). '''
+    global harvester, human_args
+    from .common import human_exceptions
+
+    languages = {}
+    for item in items:
+        # if this fails, ignore it, the worker will fail and report it later
+        with human_exceptions("File '%s':" % item, 0, True):
+            if isinstance(item, Shard):
+                examples = harvester.get_examples_from_file(item.filepath, shard=item)
+            else:
+                examples = harvester.get_examples_from_file(item)
+
+            languages[str(item)] = set(e.runner.language for e in examples)
+
+    return lambda item: languages.get(str(item))
+
+def freeze_heap():
+    ''' Move all the objects to a permanent generation so the garbage
+        collector of the workers will not touch them (and the memory
+        shared with the parent after the fork is not copied).
+
+        This is a no-op for Pythons without gc.freeze (< 3.7)
+        '''
+    if hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+
+def teardown_worker():
+    global cache, harvester, executor, human_args
+    from .common import human_exceptions
+
+    for slot_executor in (slots or [executor]):
+        with human_exceptions("While shutting down the runners:", *human_args):
+            slot_executor.shutdown_warm_runners()
+
+    if slots:
+        with cache.synced(label="slots"):
+            pass
+
+    if harvester.parse_cache is not None:
+        with human_exceptions("While saving the parse cache:", *human_args):
+            harvester.parse_cache.save()
+
 def main(args=None):
-    global cache, harvester, executor, options, human_args, dry
+    global cache, harvester, executor, options, human_args, dry, new_slot
 
-    cache_disabled = os.getenv('BYEXAMPLE_CACHE_DISABLED', "1") != "0"
-    cache_verbose  = os.getenv('BYEXAMPLE_CACHE_VERBOSE', "0") != "0"
-    cache = RegexCache('0', cache_disabled, cache_verbose)
+    cache = cache_from_env(CACHE_NAME)
 
-    with cache.activated(auto_sync=True, label="0"):
-        from .cmdline import parse_args
-        from .common import human_exceptions
-        from .init import init
+    try:
+        with cache.activated(auto_sync=True, label="0"):
+            from .cmdline import parse_args
+            from .common import human_exceptions
+            from .init import init
 
-        args = parse_args(args)
+            args = parse_args(args)
 
-        dry = args.dry
-        human_args = [args.verbosity, args.quiet]
-        with human_exceptions('During the initialization phase:', *human_args) as exc:
-            testfiles, harvester, executor, options = init(args)
+            dry = args.dry
+            human_args = [args.verbosity, args.quiet]
+            with human_exceptions('During the initialization phase:', *human_args) as exc:
+                testfiles, harvester, executor, options, new_slot = init(args)
 
-        if exc:
-            sys.exit(Status.error)
+            if exc:
+                sys.exit(Status.error)
+
+            if args.parse_cache:
+                harvester.parse_cache = ParseCache('parsed',
+                                            parse_signature(args, __version__))
+
+            # do as much as possible here, before spawning the workers,
+            # so they can share it instead of doing it each one
+            #
+            # sync the cache now so the workers do not inherit (and save
+            # again) our new entries
+            with cache.synced(label="0"):
+                harvester.warm_up()
+            freeze_heap()
+
+            history = None if args.x_no_history else History('history')
+
+            observers = []
+            if args.shard_at:
+                observers.append(ShardReport(args.verbosity, args.quiet))
+
+            results = None
+            if args.incremental:
+                runners = [harvester.runner_by_language[l] for l in harvester.allowed_languages
+                                if l in harvester.runner_by_language]
+                signature = environment_signature(args, runners, __version__)
+
+                results = ResultStore('results', signature)
+                testfiles = skip_cached(results, testfiles, args.verbosity, args.quiet)
+
+                # a dry run does not execute anything so it does not tell
+                # us if the files pass or not: do not record them
+                if not args.dry:
+                    observers.append(results)
+
+                if not testfiles:
+                    return Status.ok
+
+            admission = None
+            if args.max_concurrent or args.x_min_free_memory:
+                admission = Admission(languages_of(testfiles), dict(args.max_concurrent),
+                                        args.x_min_free_memory * 1024 * 1024,
+                                        args.verbosity)
+
+            njobs, nslots = plan_jobs(args.jobs, args.x_files_per_job, len(testfiles))
+            jobs = Jobs(njobs, args.verbosity, history, observers,
+                            admission, nslots)
+            executor.cancelled = jobs.cancelled
+
+            exit_status = jobs.run(execute_examples, testfiles, options['fail_fast'],
+                                    teardown_worker, setup_slot)
+
+            if history is not None:
+                history.save()
+
+            if results is not None:
+                results.save()
 
-        jobs = Jobs(args.jobs, args.verbosity)
-        return jobs.run(execute_examples, testfiles, options['fail_fast'])
+            return exit_status
+    finally:
+        # merge the entries added by all the workers
+        cache.compact()
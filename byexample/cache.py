@@ -7,6 +7,8 @@ import sys
 import contextlib
 import fcntl
 import errno
+import mmap
+import time
 
 try:
     import cPickle as pickle
@@ -18,6 +20,13 @@ try:
 except NameError:
     unicode = str       # aka, we are in Python 3.x
 
+# name of the byexample's cache in disk
+CACHE_NAME = '0'
+
+# default limits of the cache in disk (see RegexCache.compact)
+MAX_ENTRIES = 8192
+MAX_BYTES = 32 * 1024 * 1024
+
 @contextlib.contextmanager
 def flock(file, shared=False):
     fcntl.lockf(file.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
@@ -44,23 +53,196 @@ def create_file_new_or_fail(name):
 
         raise OSError(errno.EEXIST, "FileExistsError")
 
+def cache_from_env(filename, enabled=False):
+    ''' Create a RegexCache configured from the environment:
+
+         - BYEXAMPLE_CACHE_DISABLED: set it to 0 to enable the cache
+           (unless <enabled> is True, the cache is disabled by default)
+         - BYEXAMPLE_CACHE_VERBOSE: set it to 1 to log what the cache does
+         - BYEXAMPLE_CACHE_MAX_ENTRIES and BYEXAMPLE_CACHE_MAX_BYTES: the
+           limits of the cache in disk; 0 means no limit.
+        '''
+    disabled = not enabled and os.getenv('BYEXAMPLE_CACHE_DISABLED', "1") != "0"
+    verbose  = os.getenv('BYEXAMPLE_CACHE_VERBOSE', "0") != "0"
+
+    max_entries = int(os.getenv('BYEXAMPLE_CACHE_MAX_ENTRIES', MAX_ENTRIES))
+    max_bytes   = int(os.getenv('BYEXAMPLE_CACHE_MAX_BYTES', MAX_BYTES))
+
+    return RegexCache(filename, disabled, verbose, max_entries, max_bytes)
+
 
 class RegexCache(object):
-    def __init__(self, filename, disabled=False, cache_verbose=False):
+    r'''
+    Cache of compiled regexs (their bytecode) saved in disk.
+
+    The cache in disk is made of:
+     - a compacted store: an index (<filename>.idx) of the entries
+       and their offsets in the data file (<filename>.dat)
+     - one append-only segment file per process (<filename>.seg-<pid>)
+       with the entries added by that process.
+
+    Loading the cache only loads the index: each entry is read
+    from the (mmap'd) data file only when it is needed.
+
+    Each process appends its new entries to its segment on sync
+    so several processes can write at the same time without
+    blocking each other.
+
+    Once all the processes finished, the segments are merged into
+    the compacted store with compact(). A process merges them earlier
+    if its segment grows beyond the limits of the cache (see below).
+
+    Each entry remembers when it was used for the last time so the
+    compaction can evict the least recently used entries if the cache
+    has more than <max_entries> entries or takes more than <max_bytes>
+    bytes (0 means no limit).
+
+        >>> import os
+        >>> from byexample.cache import RegexCache
+        >>> name = 'doctest-%i' % os.getpid()
+
+        >>> writer1 = RegexCache(name)
+        >>> writer2 = RegexCache(name)
+
+        >>> _ = writer1.get(r'foo+'); _ = writer2.get(r'bar+')
+        >>> writer1._sync(); writer2._sync()
+
+    Until the compaction, the new entries are not seen by anyone:
+
+        >>> len(RegexCache(name))
+        0
+
+        >>> writer1.compact()
+        >>> len(RegexCache(name))
+        2
+
+    A bounded cache keeps the entries used more recently:
+
+        >>> writer3 = RegexCache(name, max_entries=2)
+        >>> _ = writer3.get(r'bar+'); _ = writer3.get(r'baz+')
+
+    The hits, misses and rebuilds of the in-process memo of regexs and of
+    the store of bytecodes are counted separately ('bar+' was loaded
+    from the store, 'baz+' was compiled):
+
+        >>> _ = writer3.get(r'bar+')
+        >>> stats = writer3.tier_stats()
+        >>> stats['memo'], stats['store']
+        ((1, 2, 2), (1, 1, 1))
+
+        >>> writer3.compact()
+
+        >>> cache = RegexCache(name)
+        >>> sorted(key[0] for key in cache._index)
+        ['bar+', 'baz+']
+
+        >>> stats = cache.stats()
+        >>> stats['entries'], stats['hits'], stats['misses'], stats['evictions']
+        (2, 1, 3, 1)
+
+    Compacting is cheap if nothing changed: without segments to merge
+    nothing is written and if the entries were only used, only the
+    index is rewritten:
+
+        >>> idx_inode = lambda: os.stat(cache.filename + '.idx').st_ino
+        >>> dat_inode = lambda: os.stat(cache.filename + '.dat').st_ino
+        >>> idx, dat = idx_inode(), dat_inode()
+
+        >>> cache.compact()
+        >>> idx == idx_inode(), dat == dat_inode()
+        (True, True)
+
+        >>> _ = cache.get(r'bar+')
+        >>> cache.compact()
+        >>> idx == idx_inode(), dat == dat_inode()
+        (False, True)
+
+    The cache written by older versions of byexample, a single file,
+    is merged and removed:
+
+        >>> import pickle
+        >>> bytecode = cache._pattern_to_bytecode(r'qux+')
+        >>> with open(cache.filename, 'wb') as f:
+        ...     pickle.dump({(r'qux+', 0): bytecode}, f)
+
+        >>> cache.compact()
+        >>> sorted(key[0] for key in RegexCache(name)._index)
+        ['bar+', 'baz+', 'qux+']
+
+        >>> os.path.exists(cache.filename)
+        False
+
+    The segments do not grow without limit: a process merges them as soon
+    as its segment has more than <max_entries> entries or takes more than
+    <max_bytes> bytes:
+
+        >>> writer4 = RegexCache(name, max_entries=2)
+        >>> _ = [writer4.get(p) for p in (r'a+', r'b+', r'c+')]
+        >>> writer4._sync()
+
+        >>> writer4.stats()['segments'], len(RegexCache(name))
+        (0, 2)
+
+    Only the new entries count: using the entries already in the compacted
+    store, again and again, does not merge the segments each time (each
+    key is recorded as used once per segment):
+
+        >>> writer5 = RegexCache(name, max_entries=2)
+        >>> idx = idx_inode()
+
+        >>> for _ in range(3):
+        ...     _ = [writer5.get(key[0], key[1]) for key in writer5._index]
+        ...     writer5._sync()
+
+        >>> idx == idx_inode(), writer5.stats()['segments']
+        (True, 1)
+
+        >>> cache.remove_from_disk()
+    '''
+    def __init__(self, filename, disabled=False, cache_verbose=False,
+                                    max_entries=0, max_bytes=0):
         self.disabled = disabled
         self.verbose = cache_verbose
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
         if self.disabled:
             return
 
+        # the regex objects already built: a hit here does not need
+        # to rebuild the regex from its bytecode
+        self._compiled = {}
+
+        # the bytecodes already loaded or compiled
+        self._cache = self._new_cache()
+
+        # the bytecodes that are in the compacted store (not loaded yet)
+        # and the bytecodes that we need to append to our segment
+        self._index, self._data = {}, b''
+        self._new = {}
+
+        # the keys loaded from the compacted store that were used:
+        # we need to update when they were used for the last time
+        self._used = set()
+
+        # the stats since the creation of the cache in disk
+        self._disk_stats = self._new_stats()
+
+        # how many new entries we appended to our segment and which
+        # keys we recorded there as used
+        self._segment_entries = 0
+        self._segment_used = set()
+
         if filename:
             self.filename = self._cache_filepath(filename)
-            self._cache = self._load_cache_from_disk()
+            self._load_cache_from_disk()
         else:
             self.filename = None
-            self._cache = self._new_cache()
 
         self.clear_stats()
-        self._log("Cache '%s': %i entries" % (self.filename, self._nkeys))
+        self._log("Cache '%s': %i entries" % (self.filename, len(self)))
+
+    def __len__(self):
+        return len(set(self._index) | set(self._cache))
 
     @contextlib.contextmanager
     def synced(self, label=""):
@@ -100,7 +282,73 @@ class RegexCache(object):
             self._unpatch()
 
     def clear_stats(self):
-        self._nkeys, self._hits = len(self._cache), 0
+        # stats of the bytecodes' store: the hits, the misses (bytecodes
+        # compiled from its pattern) and the rebuilds (bytecodes loaded
+        # from the compacted store)
+        self._hits, self._misses, self._loads = 0, 0, 0
+
+        # stats of the regex objects' memo: the hits, the misses and
+        # the rebuilds (regex objects built from a bytecode)
+        self._memo_hits, self._memo_misses, self._rebuilds = 0, 0, 0
+
+    def tier_stats(self):
+        ''' Return the hits, misses and rebuilds of the in-process memo of
+            regex objects and of the store of bytecodes since the last
+            clear_stats.
+            '''
+        return {
+            'memo': (self._memo_hits, self._memo_misses, self._rebuilds),
+            'store': (self._hits, self._misses, self._loads),
+            }
+
+    def _new_stats(self):
+        return {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def stats(self):
+        ''' Return the stats of the cache in disk: the count of entries
+            and their size, the hits, misses and evictions since the
+            creation of the cache, and the count of segments not
+            merged yet.
+
+            The stats of the segments are not included until they are
+            merged by compact().
+            '''
+        stats = dict(self._disk_stats)
+
+        segments = self._segment_filepaths() if self.filename else []
+        size = 0
+        for filepath in [self.filename + '.idx', self.filename + '.dat'] + segments \
+                            if self.filename else []:
+            try:
+                size += os.stat(filepath).st_size
+            except OSError:
+                pass
+
+        stats.update({
+            'entries': len(self._index),
+            'size': size,
+            'segments': len(segments),
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            })
+        return stats
+
+    def stats_report(self):
+        ''' Return a human readable report of the stats of the cache.'''
+        stats = self.stats()
+
+        lookups = stats['hits'] + stats['misses']
+        ratio = (100.0 * stats['hits'] / lookups) if lookups else 0.0
+
+        limit = lambda n, unit: (' (max %i%s)' % (n, unit)) if n else ''
+        return '\n'.join([
+            "Regex cache: %s" % self.filename,
+            "Entries: %i%s" % (stats['entries'], limit(stats['max_entries'], '')),
+            "Size on disk: %i bytes%s" % (stats['size'], limit(stats['max_bytes'], ' bytes')),
+            "Hits: %i Misses: %i (hit ratio: %0.1f%%)" % (stats['hits'], stats['misses'], ratio),
+            "Evictions: %i" % stats['evictions'],
+            "Segments not compacted yet: %i" % stats['segments'],
+            ]) + '\n'
 
     @classmethod
     def _cache_filepath(cls, filename):
@@ -137,97 +385,387 @@ class RegexCache(object):
         if self.verbose:
             print(msg)
 
+    @contextlib.contextmanager
+    def _locked(self, shared=False):
+        ''' Lock the compacted store: shared for reading it,
+            exclusive for rewriting it. '''
+        with open(self.filename + '.lock', 'a+b') as f, flock(f, shared):
+            yield
+
     def _load_cache_from_disk(self):
-        ''' Load the cache from disk, create an empty one if the
-            cache doesn't exist.
+        ''' Load the index of the compacted store and map (mmap) its
+            data file so each entry can be loaded when needed.
 
-            If the load/read fails, return a empty cache too.
+            If the load/read fails, start with an empty cache.
             '''
-        try:
-            with open(self.filename, 'rb') as f, flock(f, shared=True):
-                return self._read_cache_or_empty(f)
-        except IOError as e:
-            if e.errno == errno.ENOENT:    # aka Python 3.3's FileNotFoundError
-                return self._create_empty_cache_in_disk()
-            else:
+        with self._locked(shared=True):
+            try:
+                with open(self.filename + '.idx', 'rb') as f:
+                    index, stats = self._read_cache_or_empty(f)
+
+                with open(self.filename + '.dat', 'rb') as f:
+                    data = self._map_file(f)
+            except IOError as e:
+                if e.errno == errno.ENOENT:    # aka Python 3.3's FileNotFoundError
+                    self._log("Cache file '%s' does not exist." % self.filename)
+                    return
                 raise
 
+        self._index, self._data = index, data
+        self._disk_stats = stats
+
+    def _map_file(self, f):
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return b''     # mmap does not support empty files
+
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
     def _read_cache_or_empty(self, file):
-        ''' Read from the given file and load the cache.
+        ''' Read from the given file and load the index and the stats.
             Assumes that the file is open for reading and its read
             pointer is at the begin of the file.
 
-            This does not set any lock: use flock yourself to avoid
-            a race condition.
-
-            Return an empty cache if the read fails.
+            Return an empty index if the read fails.
             '''
         try:
-            return pickle.loads(file.read())
+            index, stats = pickle.loads(file.read())
+            return index, stats
         except:
             # possible corrupt cache, ignore it
             self._log("Warning. Cache file '%s' corrupted." % self.filename)
-            return self._new_cache()
+            return self._new_cache(), self._new_stats()
 
     def _new_cache(self):
         return {}
 
-    def _create_empty_cache_in_disk(self):
-        ''' Create an empty cache in disk if doesn't exist yet. '''
-        cache = self._new_cache()
-        try:
-            self._log("Cache file '%s' does not exist. Creating a new one..." % self.filename)
-            with create_file_new_or_fail(self.filename) as f, flock(f):
-                # the open didn't fail, so it *must* be new:
-                # save an empty cache
-                pickle.dump(cache, f)
-        except OSError as e:
-            if e.errno == errno.EEXIST:     # aka Python 3.3's FileExistsError
-                pass
+    def _load_entry(self, key):
+        ''' Load the bytecode of <key> from the compacted store. '''
+        offset, length, _ = self._index[key]
+        return pickle.loads(self._data[offset:offset+length])
+
+    def _segment_filepath(self):
+        return '%s.seg-%i' % (self.filename, os.getpid())
+
+    def _segment_filepaths(self):
+        dirname, basename = os.path.split(self.filename)
+        prefix = basename + '.seg-'
+        return [os.path.join(dirname, f) for f in os.listdir(dirname)
+                    if f.startswith(prefix)]
+
+    def _read_segment(self, f):
+        ''' Read all the records of a segment, ignoring any partially
+            written record at the end.
+
+            Return the new entries, when each entry was used for the
+            last time and the stats of the segment.
+            '''
+        entries, last_used = {}, {}
+        hits = misses = 0
+        while True:
+            try:
+                key, bytecode, when = pickle.load(f)
+            except EOFError:
+                break
+            except:
+                self._log("Warning. Cache segment '%s' corrupted." % f.name)
+                break
+
+            if key is None:
+                # stats record
+                h, m = bytecode
+                hits, misses = hits + h, misses + m
+                continue
+
+            # bytecode is None if the entry was only used (it is
+            # already in the compacted store)
+            if bytecode is not None:
+                entries[key] = bytecode
+            last_used[key] = max(when, last_used.get(key, 0))
+
+        return entries, last_used, (hits, misses)
+
+    def _sync(self, label=""):
+        ''' Append the new entries to our segment in disk. '''
+        if self.verbose:
+            self._log("[%s] Cache stats: %i entries %i hits %i misses %i loads; memo: %i hits %i misses %i rebuilds." \
+                        % (label, len(self), self._hits, self._misses, self._loads,
+                            self._memo_hits, self._memo_misses, self._rebuilds))
+        if (self._new or self._used or self._hits or self._misses) and self.filename != None:
+            self._log("[%s] Cache require sync (%i new entries)." % (label, len(self._new)))
+            now = time.time()
+            with self._open_segment() as f:
+                dump = lambda record: pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+                for key, bytecode in self._new.items():
+                    dump((key, bytecode, now))
+
+                # a key already recorded as used in our segment is not
+                # recorded again: the segment would grow with each sync
+                # (so its last use is approximated by its first use in
+                # the segment)
+                used = self._used.difference(self._new, self._segment_used)
+                for key in used:
+                    dump((key, None, now))
+
+                dump((None, (self._hits, self._misses), now))
+
+                # only the new entries count: the used ones are bounded
+                # by the keys of the compacted store
+                self._segment_entries += len(self._new)
+                self._segment_used.update(used)
+                size = f.tell()
+
+            self._new.clear()
+            self._used.clear()
+
+            if (self.max_entries and self._segment_entries > self.max_entries) or \
+                    (self.max_bytes and size > self.max_bytes):
+                self._log("[%s] Cache segment too large (%i entries, %i bytes)." % (
+                                            label, self._segment_entries, size))
+                self._merge_segments()
+
+        self.clear_stats()
+
+    @contextlib.contextmanager
+    def _open_segment(self):
+        ''' Open and lock our segment for appending.
+
+            Another process may merge and remove the segment between the
+            open and the lock (see _merge_segments): in that case, open
+            it again.
+            '''
+        while True:
+            with open(self._segment_filepath(), 'ab') as f, flock(f):
+                st = os.fstat(f.fileno())
+                if not st.st_nlink:
+                    continue
+
+                if not st.st_size:
+                    self._segment_entries = 0
+                    self._segment_used.clear()
+
+                f.seek(0, os.SEEK_END)
+                yield f
+                return
+
+    def compact(self):
+        ''' Merge the compacted store with all the segments in disk
+            (ours and the ones from other processes), then remove the
+            segments.
+
+            Other processes may keep adding entries while we compact:
+            they will append them to new segments.
+            '''
+        if self.disabled or self.filename is None:
+            return
+
+        self._sync("compact")
+        self._merge_segments()
+
+    def _merge_segments(self):
+        ''' Merge the segments and the cache written by older versions of
+            byexample (if any) into the compacted store, evicting the
+            least recently used entries (see _evict).
+
+            The data file is rewritten only if there are new entries or
+            some were evicted, otherwise only the index is.
+            '''
+        with self._locked():
+            segments = self._segment_filepaths()
+            legacy = self._pop_legacy_cache()
+            if not segments and not legacy:
+                self._log("Cache compacted: nothing to merge.")
+                return
+
+            # read the index of the current compacted store
+            try:
+                with open(self.filename + '.idx', 'rb') as f:
+                    index, stats = self._read_cache_or_empty(f)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                index, stats = {}, self._new_stats()
+
+            sizes, last_used = {}, {}
+            for key, (offset, length, when) in index.items():
+                sizes[key] = length
+                last_used[key] = when
+
+            new = {}
+            for key, (bytecode, when) in legacy.items():
+                if key not in sizes:
+                    new[key] = pickle.dumps(bytecode, pickle.HIGHEST_PROTOCOL)
+                    sizes[key] = len(new[key])
+                    last_used[key] = when
+
+            # merge the segments
+            for segment in segments:
+                with open(segment, 'r+b') as f, flock(f):
+                    entries, used, (hits, misses) = self._read_segment(f)
+                    for key, bytecode in entries.items():
+                        new[key] = pickle.dumps(bytecode, pickle.HIGHEST_PROTOCOL)
+                        sizes[key] = len(new[key])
+
+                    for key, when in used.items():
+                        last_used[key] = max(when, last_used.get(key, 0))
+
+                    stats['hits'] += hits
+                    stats['misses'] += misses
+
+                    os.remove(segment)
+
+            evicted = self._evict(sizes, last_used)
+            stats['evictions'] += evicted
+
+            if not new and not evicted:
+                # the same entries in the same place: only when they were
+                # used for the last time changed
+                index = dict((key, (offset, length, last_used[key]))
+                                for key, (offset, length, _) in index.items())
+                self._write_index(index, stats)
             else:
+                self._write_compacted(self._serialized_entries(index, new, sizes),
+                                        last_used, stats)
+
+        self._load_cache_from_disk()
+        self._log("Cache compacted: %i entries (%i segments merged, %i evicted)." % (
+                                                    len(sizes), len(segments), evicted))
+
+    def _pop_legacy_cache(self):
+        ''' Read and remove the cache written by older versions of
+            byexample: a single file with all the bytecodes.
+
+            Return the bytecodes and when they were used for the last
+            time (the modification time of the file).
+
+            Assumes that the lock (exclusive) is held.
+            '''
+        try:
+            with open(self.filename, 'rb') as f:
+                when = os.fstat(f.fileno()).st_mtime
+                try:
+                    cache = pickle.loads(f.read())
+                except:
+                    cache = None
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return {}
+            raise
+
+        os.remove(self.filename)
+        if not isinstance(cache, dict):
+            self._log("Warning. Old cache file '%s' corrupted." % self.filename)
+            return {}
+
+        self._log("Migrating the old cache file '%s' (%i entries)." % (
+                                                    self.filename, len(cache)))
+        return dict((key, (bytecode, when)) for key, bytecode in cache.items())
+
+    def _serialized_entries(self, index, new, keys):
+        ''' Return the serialized entries of <keys>: the <new> ones and
+            the ones from the compacted store (see <index>).
+
+            Assumes that the lock is held.
+            '''
+        try:
+            with open(self.filename + '.dat', 'rb') as f:
+                data = f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
                 raise
+            data = b''
 
-        return cache
+        entries = {}
+        for key in keys:
+            if key in new:
+                entries[key] = new[key]
+            else:
+                offset, length, _ = index[key]
+                entries[key] = data[offset:offset+length]
 
+        return entries
 
-    def _sync(self, label=""):
-        misses = len(self._cache) - self._nkeys
-        nohits = self._nkeys - self._hits
-
-        self._log("[%s] Cache stats: %i entries %i hits %i misses %i nohits." \
-                    % (label, len(self._cache), self._hits, misses, nohits))
-        if misses and self.filename != None:
-            self._log("[%s] Cache require sync." % label)
-            with open(self.filename, 'rb+') as f, flock(f):
-                # get a fresh disk version in case that other
-                # byexample instance had touched the cache but
-                # do not keep updating if we have too many nohits (useless
-                # keys/entries)
-                if nohits < 1000:
-                    cache = self._read_cache_or_empty(f)
-                    cache.update(self._cache)
-                else:
-                    cache = self._cache
-
-                # write to disk the new updated cache, truncate
-                # and shrink it if the new is smaller than the original.
-                f.seek(0,0)
-                # XXX pickletools.optimize ??
-                pickle.dump(cache, f)
-                f.truncate()
-
-            self.clear_stats()
+    def _evict(self, sizes, last_used):
+        ''' Remove from <sizes> (the size of each entry) the least
+            recently used entries until the cache is under its
+            limits (max_entries and max_bytes).
+
+            Return how many entries were evicted.
+            '''
+        if not self.max_entries and not self.max_bytes:
+            return 0
+
+        keys = sorted(sizes, key=lambda k: last_used.get(k, 0), reverse=True)
+
+        nkeys, size = 0, 0
+        for key in keys:
+            size += sizes[key]
+            if (self.max_entries and nkeys + 1 > self.max_entries) or \
+                    (self.max_bytes and size > self.max_bytes):
+                break
+            nkeys += 1
+
+        for key in keys[nkeys:]:
+            del sizes[key]
+
+        return len(keys) - nkeys
+
+    def _write_compacted(self, entries, last_used, stats):
+        ''' Write the <entries> (already serialized), when they were used
+            for the last time and the <stats> in a new compacted
+            store replacing atomically the old one.
+
+            Assumes that the lock (exclusive) is held.
+            '''
+        index = {}
+        tmp = '%s.tmp-%i' % (self.filename, os.getpid())
+        with open(tmp + '.dat', 'wb') as f:
+            offset = 0
+            for key, blob in entries.items():
+                f.write(blob)
+                index[key] = (offset, len(blob), last_used.get(key, 0))
+                offset += len(blob)
+
+        # the readers (shared lock) will see the old or the new store
+        # but never a mix of them
+        os.rename(tmp + '.dat', self.filename + '.dat')
+        self._write_index(index, stats)
+
+    def _write_index(self, index, stats):
+        ''' Write the <index> and the <stats> replacing atomically the
+            old ones.
+
+            Assumes that the lock (exclusive) is held.
+            '''
+        tmp = '%s.tmp-%i' % (self.filename, os.getpid())
+        with open(tmp + '.idx', 'wb') as f:
+            pickle.dump((index, stats), f, pickle.HIGHEST_PROTOCOL)
+
+        os.rename(tmp + '.idx', self.filename + '.idx')
+
+    def remove_from_disk(self):
+        ''' Remove the cache from disk. '''
+        for f in ['.idx', '.dat', '.lock']:
+            try:
+                os.remove(self.filename + f)
+            except OSError:
+                pass
+
+        for segment in self._segment_filepaths():
+            os.remove(segment)
 
     def get(self, pattern, flags=0):
         ''' RegexCache.get compiles a pattern into a regex object like
             re.compile does.
 
-            At difference with re.compile, RegexCache.get caches the
-            bytecode, the internal representation of the regex
-            instead of caching the whole regex object.
+            RegexCache.get has two tiers: an in-process memo of the
+            regex objects in front of a store of bytecodes, the internal
+            representation of the regexs.
 
-            If multiple times the same pattern is built, this is slower
-            but enables us to serialize (pickle) the bytecode to disk.
+            The bytecodes, unlike the regex objects, can be serialized
+            (pickled) to disk. A bytecode is loaded from disk and turned
+            into a regex object only once per process; after that, the
+            regex object is taken from the memo.
 
                 >>> import re
                 >>> from byexample.cache import RegexCache
@@ -240,6 +778,9 @@ class RegexCache(object):
                 >>> r1.pattern == r2.pattern
                 True
 
+                >>> r2 is get(r'foo.*bar', re.DOTALL)
+                True
+
                 >>> r3 = re.compile(r2) # from another regex
                 >>> r4 = get(r2)  # but we don't support this
                 Traceback <...>
@@ -254,14 +795,34 @@ class RegexCache(object):
                                 % type(pattern))
 
         key = (pattern, flags)
+        try:
+            regex = self._compiled[key]
+            self._memo_hits += 1
+            self._used.add(key)
+            return regex
+        except KeyError:
+            self._memo_misses += 1
+
         try:
             bytecode = self._cache[key]
             self._hits += 1
+            self._used.add(key)
         except KeyError:
-            bytecode = self._pattern_to_bytecode(pattern, flags)
+            if key in self._index:
+                bytecode = self._load_entry(key)
+                self._hits += 1
+                self._loads += 1
+                self._used.add(key)
+            else:
+                bytecode = self._pattern_to_bytecode(pattern, flags)
+                self._new[key] = bytecode
+                self._misses += 1
+
             self._cache[key] = bytecode
 
-        return self._bytecode_to_regex(pattern, bytecode)
+        regex = self._compiled[key] = self._bytecode_to_regex(pattern, bytecode)
+        self._rebuilds += 1
+        return regex
 
     def _pattern_to_bytecode(self, pattern, flags=0):
         if not isinstance(pattern, (str, bytes, unicode)):
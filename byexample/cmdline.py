@@ -22,6 +22,12 @@ class _Print(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         parser.exit(message=self.message)
 
+class _CacheStats(argparse.Action):
+    r'''Print the stats of the regex cache in disk, then, exit.'''
+    def __call__(self, parser, namespace, values, option_string=None):
+        from .cache import cache_from_env, CACHE_NAME
+        parser.exit(message=cache_from_env(CACHE_NAME, enabled=True).stats_report())
+
 def _key_val_type(item):
     try:
         key, val = [i.strip() for i in item.split(":", 1)]
@@ -35,8 +41,22 @@ def _key_val_type(item):
 
     return (key, val)
 
+def _max_concurrent_type(item):
+    try:
+        language, limit = [i.strip() for i in item.replace('=', ':', 1).split(":", 1)]
+        limit = int(limit)
+        assert language and limit > 0
+    except:
+        raise argparse.ArgumentTypeError(
+                "Invalid format '%s'. Use <language>=<n> instead (<n> a positive number)." % item)
+
+    return (language, limit)
+
 def _jobs_type(item):
     jobs_str = item.strip()
+    if jobs_str == "auto":
+        return jobs_str # resolved later, see byexample.jobs.auto_jobs
+
     ncpus = 1
     if jobs_str.startswith("cpu"):
         try:
@@ -54,7 +74,7 @@ def _jobs_type(item):
         assert jobs_num > 0
     except:
         raise argparse.ArgumentTypeError(
-                "Invalid jobs specification '%s'. Use 'cpu', 'cpu<n>' or <n> (a positive number)." % item)
+                "Invalid jobs specification '%s'. Use 'auto', 'cpu', 'cpu<n>' or <n> (a positive number)." % item)
 
     return jobs_num * ncpus
 
@@ -182,9 +202,45 @@ def parse_args(args=None):
             default=1,
             type=_jobs_type,
             help='run <n> jobs in parallel (%(default)s by default); ' +\
-                 '<n> can be an integer or the string "cpu" or "cpu<n>": ' +\
+                 '<n> can be an integer or the string "auto", "cpu" or "cpu<n>": ' +\
+                 '"auto" means guess it from the cpus, memory and load of the system; ' +\
                  '"cpu" means use all the cpus available; ' +\
                  '"cpu<n>" multiply it by <n> the cpus available.')
+    g.add_argument(
+            "--shard-at",
+            metavar='<regex>',
+            default=None,
+            help='split each file in shards at the lines that match <regex> ' +\
+                 '(like "^## " for the sections of a Markdown file); ' +\
+                 'each shard is run by its own job with its own runners.')
+    g.add_argument(
+            "--max-concurrent",
+            action='append',
+            metavar='<language>=<n>',
+            default=[],
+            type=_max_concurrent_type,
+            help='run at most <n> files of <language> at the same time ' +\
+                 '(like cpp=4 for heavy interpreters); the rest of the ' +\
+                 'files keep running in the free jobs meanwhile.')
+    g.add_argument(
+            "--incremental",
+            action='store_true',
+            help="do not run the files that passed in a previous run " +\
+                 "if neither they nor the environment changed (the options, " +\
+                 "the version of byexample, the interpreters and the files " +\
+                 "given with --depends-on).")
+    g.add_argument(
+            "--depends-on",
+            nargs='+',
+            metavar='<file>',
+            default=[],
+            help='with --incremental, run all the files again if any of ' +\
+                 'these files changed (like the source code used by the examples).')
+    g.add_argument(
+            "--parse-cache",
+            action='store_true',
+            help="keep the examples found and parsed in a cache and reuse " +\
+                 "them if neither the file nor the options changed.")
     g.add_argument(
             "--dry",
             action='store_true',
@@ -258,6 +314,12 @@ def parse_args(args=None):
                                         author=_author,
                                         url=_url)),
             help='show %(prog)s\'s version and license, then exit')
+    g.add_argument(
+            '--cache-stats',
+            nargs=0,
+            action=_CacheStats,
+            help='show the stats of the cache (entries, hit ratio, size on disk ' +\
+                 'and evictions), then exit')
 
     g = parser.add_argument_group("Logging")
     mutexg = g.add_mutually_exclusive_group()
@@ -323,6 +385,38 @@ def parse_args(args=None):
             "-x-not-recover-timeout",
             action='store_true',
             help="do not try to recover from a timeout; abort the execution immediately (beware, this could leave some resources without the proper clean up).")
+    g.add_argument(
+            "-x-no-history",
+            action='store_true',
+            help="do not use nor update the history of how long took to run each file (used to run the longest files first).")
+    g.add_argument(
+            "-x-min-free-memory",
+            metavar="<MB>",
+            default=0,
+            type=int,
+            help="do not start a new file while the available memory is below <MB> megabytes; 0 disable this (default).")
+    g.add_argument(
+            "-x-reuse-runners",
+            action='store_true',
+            help="do not shutdown the runners after running a file; reset them and reuse them for the next file (runners that cannot be reset are restarted in background).")
+    g.add_argument(
+            "-x-pipeline",
+            metavar="<n>",
+            default=1,
+            type=int,
+            help="send up to <n> consecutive examples to the runner without waiting for the output of the previous ones; 1 disable this (default).")
+    g.add_argument(
+            "-x-spill-output",
+            metavar="<MB>",
+            default=64,
+            type=int,
+            help="keep the output of an example in a temporary file once it is larger than <MB> megabytes; 0 disable this (default: %(default)s).")
+    g.add_argument(
+            "-x-files-per-job",
+            metavar="<n>",
+            default=1,
+            type=int,
+            help="run up to <n> files at the same time in each job, each with its own runners, so a job does not sit idle while it waits for an interpreter (default: %(default)s).")
     namespace = parser.parse_args(args)
 
     # Some extra checks
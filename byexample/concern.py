@@ -61,13 +61,13 @@ class Concern(ExtendOptionParserMixin):
         Called at the begin of the execution of the given examples
         found in the specific filepath with the given runners.
 
-        The runners are already initialized but no example was built nor
-        was executed yet.
+        No example was built nor was executed yet and the runners are
+        not initialized either: each runner is initialized right before
+        running its first example that is not skipped (so the runners
+        of a file with all its examples skipped are never initialized).
 
         You could use this opportunity to alter the example, or
         even alter the example list (the parameter) in place.
-        Or you could inject some code to the given runners
-        before running any example.
 
         Keep in mind that we are talking about examples that are not fully
         parsed yet so you may not get all their attributs.
@@ -1,11 +1,21 @@
 from __future__ import unicode_literals
 from .common import log, print_example, print_execution, enhance_exceptions
+import threading, signal, contextlib
 
 class TimeoutException(Exception):
     def __init__(self, msg, output):
         Exception.__init__(self, msg);
         self.output = output
 
+class CancelledException(Exception):
+    pass
+
+def _raise_cancelled(signum, frame):
+    raise CancelledException("Execution cancelled.")
+
+# the only thread that can handle the signals (we are imported by it)
+_main_thread = threading.current_thread()
+
 class FileExecutor(object):
     def __init__(self, concerns, differ, verbosity, use_colors, options, **unused):
         self.concerns   = concerns
@@ -15,18 +25,173 @@ class FileExecutor(object):
 
         self.options = options
 
+        # runners kept alive between files (see release_runners)
+        # and the threads that are (re)initializing them in background
+        self.reuse_runners = options['x']['reuse_runners']
+        self.warm_runners = {}
+
+        # the runners initialized at least once, released when there
+        # is no more files to process (see shutdown_warm_runners)
+        self.used_runners = []
+
+        # how many examples send to a runner in a row (see _pipeline)
+        self.pipeline = options['x']['pipeline']
+
+        # an Event shared with the other workers, set when all of
+        # them must stop (see Jobs.cancel_workers)
+        self.cancelled = None
+
+    def is_cancelled(self):
+        return self.cancelled is not None and self.cancelled.is_set()
+
+    @contextlib.contextmanager
+    def cancellable(self, enabled):
+        ''' Allow to interrupt the running example with a SIGUSR1
+            (see Jobs.cancel_workers) raising a CancelledException.
+
+            Only the main thread can handle the signal: in a slot
+            (see slotted_worker) the execution is cancelled between
+            example and example only.
+            '''
+        if self.cancelled is None or not enabled or \
+                threading.current_thread() is not _main_thread:
+            yield
+            return
+
+        prev = signal.signal(signal.SIGUSR1, _raise_cancelled)
+        try:
+            # we may lost the signal if it was sent before setting
+            # the handler
+            if self.cancelled.is_set():
+                raise CancelledException("Execution cancelled.")
+            yield
+        finally:
+            signal.signal(signal.SIGUSR1, prev)
+
     def initialize_runners(self, runners, options):
         tmp = []
         for runner in runners:
-            log("Initializing %s" % str(runner), 'chat', self.concerns)
+            self._mark_as_used(runner)
             try:
-                runner.initialize(options)
+                if runner in self.warm_runners:
+                    self._wait_warm_runner(runner, options)
+                else:
+                    log("Initializing %s" % str(runner), 'chat', self.concerns)
+                    runner.initialize(options)
                 tmp.append(runner)
             except:
+                self._discard_runner(runner)
                 self.shutdown_runners(tmp, stop_on_failure=False)
                 log("Initialization of %s failed." % str(runner), 'error', self.concerns)
                 raise
 
+    def _wait_warm_runner(self, runner, options):
+        ''' Take a runner from the warm runners. If it is being
+            initialized in background, wait for it; if that failed,
+            initialize it again here.
+            '''
+        thread, failure = self.warm_runners.pop(runner)
+        if thread is not None:
+            thread.join()
+
+        if failure:
+            log("Background initialization of %s failed; initializing it again." % str(runner),
+                    'chat', self.concerns)
+            runner.initialize(options)
+        elif thread is None:
+            log("Reusing %s" % str(runner), 'chat', self.concerns)
+        else:
+            log("Initialized %s in background" % str(runner), 'chat', self.concerns)
+
+    def _mark_as_used(self, runner):
+        if runner not in self.used_runners:
+            self.used_runners.append(runner)
+
+    def _discard_runner(self, runner):
+        ''' Shutdown a runner that failed to initialize so its
+            interpreter, if it was spawned, is not left behind.
+            Any error is ignored: the runner is broken anyway.
+            '''
+        try:
+            runner.shutdown()
+        except Exception:
+            pass
+
+    def _initialize_in_background(self, runner, options):
+        ''' Start the initialization of the runner in a separated
+            thread so it can boot while we are doing something else. '''
+        self._mark_as_used(runner)
+
+        failure = []
+        def _initialize():
+            try:
+                runner.initialize(options)
+            except Exception as e:
+                self._discard_runner(runner)
+                failure.append(e)
+
+        thread = threading.Thread(target=_initialize)
+        thread.daemon = True
+        thread.start()
+
+        self.warm_runners[runner] = (thread, failure)
+
+    def release_runners(self, runners, options, reusable):
+        ''' Release the runners used to execute the examples of a file.
+
+            If the reuse of the runners is enabled and the runners are
+            <reusable> (they did not crash, for example), reset them and keep
+            them alive for the next file.
+
+            If a runner cannot be reset, shut it down and initialize it again
+            in background.
+
+            Otherwise, just shut them down.
+            '''
+        if not (self.reuse_runners and reusable):
+            return self.shutdown_runners(runners)
+
+        for runner in runners:
+            log("Resetting %s" % str(runner), 'chat', self.concerns)
+            try:
+                if runner.reset(options):
+                    self.warm_runners[runner] = (None, [])
+                    continue
+            except Exception as e:
+                log("Reset of %s failed: %s" % (str(runner), str(e)), 'chat', self.concerns)
+
+            self.shutdown_runners([runner])
+
+            # a copy: the options are modified by the examples while
+            # the runner is being initialized in background
+            self._initialize_in_background(runner, options.copy())
+
+    def shutdown_warm_runners(self, runners=None):
+        ''' Shutdown the given runners (all by default) that were kept
+            alive for the next file. Call this once there is no more files
+            to process.
+
+            By default, release also every runner used (see
+            ExampleRunner.release), even the ones already shutdown.
+            '''
+        release = runners is None
+        runners = list(self.warm_runners if runners is None else runners)
+        for runner in list(runners):
+            thread, failure = self.warm_runners.pop(runner)
+            if thread is not None:
+                thread.join()
+            if failure:
+                runners.remove(runner)
+
+        self.shutdown_runners(runners, stop_on_failure=False)
+
+        if release:
+            for runner in self.used_runners:
+                try:
+                    runner.release()
+                except Exception as e:
+                    log("Release of %s failed: %s" % (str(runner), str(e)), 'error', self.concerns)
+
     def shutdown_runners(self, runners, stop_on_failure=True):
         tmp = list(runners)
         for runner in runners:
@@ -59,37 +224,147 @@ class FileExecutor(object):
         options = self.options
         runners = list(set(e.runner for e in examples))
 
-        self.initialize_runners(runners, options)
+        # the runners are initialized on demand, right before their
+        # first example that is not skipped (see _start_runner), and
+        # only those are released at the end; a runner that could
+        # not be initialized makes the file end with an error
+        started = []
+        init_failures = {}
+        reusable = False
+
+        # if more than one runner will be needed, start all of them now
+        # at the same time (see _start_runners_in_background)
+        in_background = self._start_runners_in_background(examples, runners, options)
         try:
             self.concerns.start(examples, runners, filepath, options)
             failed, user_aborted, crashed, broken, timedout = self._exec(examples, filepath,
-                                                               options, runners)
+                                                               options, started,
+                                                               init_failures)
             self.concerns.finish(failed, user_aborted, crashed, broken, timedout)
+
+            # the runners are in a well known state only if nothing
+            # weird happen
+            reusable = not (user_aborted or crashed or timedout)
         finally:
-            self.shutdown_runners(runners)
+            self.release_runners(started, options, reusable)
+
+            # the runners initialized in background but not used (like
+            # if the rest of the examples were skipped): keep them for the
+            # next file or shut them down
+            unused = [r for r in in_background if r in self.warm_runners]
+            if unused and not (self.reuse_runners and reusable):
+                self.shutdown_warm_runners(unused)
+
+        return failed, (crashed or broken or timedout), user_aborted, bool(init_failures)
+
+    def _start_runners_in_background(self, examples, runners, options):
+        ''' Initialize in background (see _initialize_in_background)
+            the <runners> that have at least one example not skipped by
+            its own options so they boot at the same time and the file
+            waits for the slowest of them only, not for all of them one
+            after the other.
 
-        return failed, (crashed or broken or timedout), user_aborted, False
+            This is done only if more than one runner is needed: a single
+            one is initialized right before its first example as usual.
+
+            Return the runners initialized in background.
+            '''
+        if len(runners) < 2:
+            return []
+
+        needed = []
+        for example in examples:
+            runner = example.runner
+            if runner in needed or runner in self.warm_runners:
+                continue
+
+            local_options = self._local_options(example)
+            if local_options is None:
+                continue
+
+            options.up(local_options)
+            try:
+                if not options['skip']:
+                    needed.append(runner)
+            finally:
+                options.down()
+
+        if len(needed) < 2:
+            return []
+
+        for runner in needed:
+            # a copy: the options are modified by the examples while
+            # the runner is being initialized in background
+            self._initialize_in_background(runner, options.copy())
+
+        return needed
+
+    def _start_runner(self, runner, started, failures, init_options):
+        ''' Initialize the <runner> unless it is already in <started>.
+
+            If the initialization fails, the exception is raised and kept
+            in <failures> so it is raised again, without retrying, if
+            the runner is needed later.
+            '''
+        if runner in failures:
+            raise failures[runner]
+
+        if runner not in started:
+            try:
+                self.initialize_runners([runner], init_options)
+            except Exception as e:
+                failures[runner] = e
+                raise
+            started.append(runner)
+
+    def _exec(self, examples, filepath, options, started, init_failures):
+        # the runners are initialized with the options of the file,
+        # not with the ones of the example that needs them first
+        init_options = options.copy()
 
-    def _exec(self, examples, filepath, options, runners):
         failing_fast = False
         failed = False
         user_aborted = False
         crashed = False
         timedout = False
         broken = False
-        for example in examples:
+
+        # examples parsed and sent ahead by _pipeline, by index
+        parsed = {}
+        submitted = set()
+        window_end = 0
+        for idx, example in enumerate(examples):
             try:
-                example = self._parse(example, options)
+                if idx in parsed:
+                    example = parsed.pop(idx)
+                else:
+                    example = self._parse(example, options)
 
                 if example == None:
                     broken = True
                     break   # cancel if an example couldn't get parsed
 
                 with enhance_exceptions(example, self, self.use_colors):
+                    # other job failed and we were cancelled: enter in
+                    # failing fast mode as if the example had failed here
+                    if not failing_fast and self.is_cancelled():
+                        failing_fast = True
+                        self.concerns.aborted(example, False, options)
+
                     # are we in failing fast mode? if we do, skip all the
                     # examples by default
                     if failing_fast:
                         options.up({'skip': True})
+                    elif self.pipeline > 1 and idx >= window_end and \
+                            self._can_be_pipelined(example, options):
+                        try:
+                            self._start_runner(example.runner, started,
+                                               init_failures, init_options)
+                        except Exception:
+                            pass    # reported below, when the example is run
+                        else:
+                            window_end = self._pipeline(examples, idx, example,
+                                                        parsed, submitted, options)
 
                     # load the example's options here to allow it to override
                     # a 'skip' if the user wants to run this even in failing fast
@@ -101,15 +376,37 @@ class FileExecutor(object):
                         fail_fast = options['fail_fast']
 
                         if options['skip']:
+                            if idx in submitted and not self._drain(example, options):
+                                crashed = failed = True
+                                self.concerns.aborted(example, False, options)
+                                break
+
                             self.concerns.skip_example(example, options)
                             continue
 
                         print_example(example, True, self.verbosity-3)
                         self.concerns.start_example(example, options)
+
+                        # a runner that cannot be initialized is reported
+                        # as a crash of the example that needed it
+                        try:
+                            self._start_runner(example.runner, started,
+                                               init_failures, init_options)
+                        except Exception as e:
+                            self.concerns.crashed(example, e)
+                            self.concerns.finally_example(example, options)
+                            crashed = failed = True
+                            self.concerns.aborted(example, False, options)
+                            break
+
+                        cancelled = False
                         try:
-                            with enhance_exceptions(example, example.runner, self.use_colors):
+                            with enhance_exceptions(example, example.runner, self.use_colors), \
+                                    self.cancellable(enabled=not failing_fast):
                                 example.got = example.runner.run(example, options)
                             self.concerns.finish_example(example, options)
+                        except CancelledException:     # pragma: no cover
+                            cancelled = True
                         except TimeoutException as e:  # pragma: no cover
                             self.concerns.timedout(example, e)
                             timedout = True
@@ -119,6 +416,22 @@ class FileExecutor(object):
                         finally:
                             self.concerns.finally_example(example, options)
 
+                        if cancelled:                  # pragma: no cover
+                            # interrupted by other job that failed, try
+                            # to recover the runner to skip the rest of the
+                            # examples (but run the ones that the user does
+                            # not want to skip like the ones for clean up)
+                            if not example.runner.cancel(example, options):
+                                crashed = failed = True
+                                self.concerns.aborted(example, False, options)
+                                break
+
+                            self.concerns.aborted(example, False, options)
+                            self.concerns.skip_example(example, options)
+                            failing_fast = True
+                            options.up({'skip': True}) # see below
+                            continue
+
                         recovered = False
                         if timedout and not options['x']['not_recover_timeout']:
                             # try to recover the control of the runner
@@ -183,6 +496,85 @@ class FileExecutor(object):
 
         return failed, user_aborted, crashed, broken, timedout
 
+    def _pipeline(self, examples, idx, example, parsed, submitted, options):
+        ''' Send to the runner of the <example> (the <idx>-th example) it
+            and the examples that follow it without waiting for their
+            outputs (see ExampleRunner.submit), up to -x-pipeline examples.
+
+            The examples sent ahead are parsed here and saved in <parsed>
+            and their indexes in <submitted>.
+
+            We stop at the first example that needs the runner to be
+            waiting for it: one that runs in another runner, that may be
+            skipped, that may fail fast or start an interactive session
+            on failure or that pastes the output of a previous example.
+
+            Return the index of the first example not sent.
+            '''
+        runner = example.runner
+        end = min(idx + self.pipeline, len(examples))
+        while True:
+            options.up(example.options)
+            try:
+                if not runner.submit(example, options):
+                    break
+            finally:
+                options.down()
+
+            submitted.add(idx)
+            idx += 1
+            if idx >= end or examples[idx].runner is not runner:
+                break
+
+            # check the options before parsing the example: a +paste
+            # needs the previous examples to be run to be parsed
+            example = examples[idx]
+            if not self._can_be_pipelined(example, options):
+                break
+
+            example = parsed[idx] = self._parse(example, options)
+            if example is None:
+                break
+
+        return idx
+
+    def _local_options(self, example):
+        ''' Return the options of the <example> without parsing it
+            or None if they cannot be extracted. '''
+        try:
+            cached = getattr(example, 'cached_parse', None)
+            if cached is None:
+                return example.parser.extract_options(example.snippet)
+            else:
+                return cached[0]
+        except Exception:
+            return None     # let _parse to report the error
+
+    def _can_be_pipelined(self, example, options):
+        local_options = self._local_options(example)
+        if local_options is None:
+            return False
+
+        options.up(local_options)
+        try:
+            return not (options['skip'] or options['fail_fast'] or \
+                        options['interact'] or options.get('paste'))
+        finally:
+            options.down()
+
+    def _drain(self, example, options):
+        ''' Wait for and discard the output of an example that was sent
+            ahead (see _pipeline) but it is skipped.
+
+            Return False if the runner is in an undefined state.
+            '''
+        try:
+            with self.cancellable(enabled=False):
+                example.runner.run(example, options)
+            return True
+        except Exception:
+            return False
+
     def _parse(self, example, options):
         try:
             with enhance_exceptions(example, example.parser, self.use_colors):
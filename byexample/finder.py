@@ -166,6 +166,7 @@ class ExampleHarvest(object):
         self.verbosity = verbosity
         self.use_colors = use_colors
         self.available_finders = registry['finders'].values()
+        self.finder_by_target = registry['finders']
         self.encoding = encoding
 
         self.parser_by_language = registry['parsers']
@@ -174,10 +175,30 @@ class ExampleHarvest(object):
 
         self.options = options
 
+        # remember the examples found and parsed (see ParseCache)
+        self.parse_cache = None
+
     def __repr__(self):
         return 'Example Harvester'
 
-    def get_examples_from_file(self, filepath):
+    def warm_up(self):
+        ''' Compile the regexs of the finders, zone delimiters and
+            parsers and build the option parsers.
+
+            Call this before spawning the workers so they inherit all of
+            this instead of doing it each one of them.
+            '''
+        for finder in self.available_finders:
+            finder.example_regex()
+
+        for zdelimiter in set(self.zdelimiter_by_file_extension.values()):
+            zdelimiter.zone_regex()
+
+        for language, parser in self.parser_by_language.items():
+            if language in self.allowed_languages:
+                parser.warm_up()
+
+    def get_examples_from_file(self, filepath, shard=None):
         try:
             f = open(filepath, 'rtU', encoding=self.encoding)
             already_encoded = True
@@ -191,9 +212,84 @@ class ExampleHarvest(object):
             if not already_encoded:
                 string = string.decode(self.encoding)
 
-        return self.get_examples_from_string(string, filepath)
+        return self.get_examples_from_string(string, filepath, shard)
 
-    def get_examples_from_string(self, string, filepath='<string>'):
+    def get_examples_from_string(self, string, filepath='<string>', shard=None):
+        if self.parse_cache is None:
+            return self._harvest_examples_from_string(string, filepath, shard)
+
+        key = self.parse_cache.key_of(filepath, shard)
+        content = self.parse_cache.content_hash(string)
+
+        records = self.parse_cache.lookup(key, content)
+        if records is not None:
+            log("File '%s': %i examples from the parse cache" % (filepath,
+                                            len(records)), self.verbosity-2)
+            return [self._example_from_record(record, parse_state, filepath)
+                        for record, parse_state in records]
+
+        all_examples = self._harvest_examples_from_string(string, filepath, shard)
+        self.parse_cache.harvested(key, content,
+                    [self._example_as_record(e) for e in all_examples],
+                    all_examples)
+        return all_examples
+
+    def record_parsed(self, filepath, shard=None):
+        ''' Record in the parse cache (if any) the examples of <filepath>
+            (or of its <shard>) once they were parsed. '''
+        if self.parse_cache is not None:
+            self.parse_cache.record_parsed(self.parse_cache.key_of(filepath, shard))
+
+    def _example_as_record(self, example):
+        r''' Return what the finder found about the <example> (see
+            _example_from_record).
+
+            The finder and the zone delimiter are recorded by their
+            keys in the registry:
+
+                >>> from byexample.finder import ExampleHarvest, Example, Where
+                >>> class Runner: language = 'python'
+                >>> finder, zdelimiter = object(), object()
+
+                >>> h = ExampleHarvest([], {'parsers': {'python': None},
+                ...                         'finders': {'python-prompt': finder},
+                ...                         'runners': {'python': Runner},
+                ...                         'zdelimiters': {'.md': zdelimiter}},
+                ...                     0, 0, None, 'utf-8')
+
+                >>> example = Example(finder, Runner, None, '1 + 2', '3', '',
+                ...                     Where(2, 3, 'file.md', zdelimiter))
+                >>> record = h._example_as_record(example)
+                >>> record
+                ('python-prompt', 'python', '1 + 2', '3', '', 2, 3, '.md')
+
+                >>> example = h._example_from_record(record, None, 'file.md')
+                >>> example.finder is finder, example.zdelimiter is zdelimiter
+                (True, True)
+            '''
+        target = next(t for t, f in self.finder_by_target.items() if f is example.finder)
+        zdelimiter = next((ext for ext, z in self.zdelimiter_by_file_extension.items()
+                                if z is example.zdelimiter), None)
+        return (target, example.runner.language, example.snippet,
+                example.expected_str, example.indentation,
+                example.start_lineno, example.end_lineno, zdelimiter)
+
+    def _example_from_record(self, record, parse_state, filepath):
+        target, language, snippet, expected, indent, start_lineno, end_lineno, \
+                zdelimiter = record
+
+        zdelimiter = self.zdelimiter_by_file_extension.get(zdelimiter)
+        where = Where(start_lineno, end_lineno, filepath, zdelimiter)
+        example = Example(self.finder_by_target[target],
+                            self.runner_by_language[language],
+                            self.parser_by_language[language],
+                            snippet, expected, indent, where)
+
+        # if it was parsed, the parser will reuse it (see ExampleParser.parse)
+        example.cached_parse = parse_state
+        return example
+
+    def _harvest_examples_from_string(self, string, filepath, shard):
         all_examples = []
         _, ext = os.path.splitext(filepath)
 
@@ -236,6 +332,13 @@ class ExampleHarvest(object):
 
         all_examples = self.check_example_overlap(all_examples, filepath)
 
+        # keep only the examples that begin in the given shard
+        # of the file; the rest will be run by someone else
+        if shard is not None:
+            all_examples = [e for e in all_examples if shard.contains(e.start_lineno)]
+            log("File '%s': %i examples in shard %s" % (filepath,
+                                len(all_examples), str(shard)), self.verbosity-2)
+
         return all_examples
 
     def check_example_overlap(self, examples, filepath):
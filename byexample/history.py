@@ -0,0 +1,233 @@
+from __future__ import unicode_literals
+import appdirs
+import os
+import re
+import errno
+
+from .cache import flock, create_file_new_or_fail
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+class Store(object):
+    ''' A dictionary saved in disk, in the user's cache directory.
+
+        The entries recorded (in <_recorded>) are merged with the ones
+        in disk on save() so several byexample instances can share the
+        same file.
+
+        If no filename is given, nothing is loaded from or saved to disk.
+        '''
+    def __init__(self, filename):
+        if filename:
+            self.filename = self._store_filepath(filename)
+            self._entries = self._load_from_disk()
+        else:
+            self.filename = None
+            self._entries = {}
+
+        self._recorded = {}
+
+    @classmethod
+    def _store_filepath(cls, filename):
+        ''' Create a valid file path based on <filename> in the
+            user's cache directory.
+
+            >>> from byexample.history import Store
+            >>> Store._store_filepath('foo/bar')
+            '<user-cache-dir>/byexample/bar'
+
+            Note: this function *will* create any directory needed.
+        '''
+        dir = appdirs.user_cache_dir(appname='byexample')
+        try:
+            os.makedirs(dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        filename = os.path.basename(filename)
+        return os.path.join(dir, filename)
+
+    def _load_from_disk(self):
+        try:
+            with open(self.filename, 'rb') as f, flock(f, shared=True):
+                return self._read_or_empty(f)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return {}
+            raise
+
+    def _read_or_empty(self, file):
+        try:
+            return pickle.loads(file.read())
+        except:
+            # possible corrupt file, ignore it
+            return {}
+
+    def save(self):
+        ''' Save the recorded entries merging them with the
+            ones in disk (another byexample instance may had
+            updated them in the meantime).
+            '''
+        if not self._recorded or self.filename is None:
+            return
+
+        try:
+            f = open(self.filename, 'rb+')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            try:
+                f = create_file_new_or_fail(self.filename)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                f = open(self.filename, 'rb+')
+
+        with f, flock(f):
+            entries = self._read_or_empty(f)
+            entries = self._merge(entries, self._recorded)
+
+            f.seek(0, 0)
+            pickle.dump(entries, f)
+            f.truncate()
+
+        self._recorded = {}
+
+    def _merge(self, entries, recorded):
+        ''' Merge the <recorded> entries into the <entries> read
+            from disk and return the entries to save. '''
+        entries.update(recorded)
+        return entries
+
+class History(Store):
+    r'''
+    Keep track of how long took to run each file in the past.
+
+    ``Jobs`` uses this to send the longest files first so the workers
+    do not sit idle at the end of the run waiting for a single slow file.
+
+        >>> from byexample.history import History
+        >>> import os
+        >>> history = History(None)
+
+    Without any history, the estimated cost of a file is its size
+    (the bigger, the longer it should take):
+
+        >>> files = ['byexample/jobs.py', 'byexample/runner.py']
+        >>> history.estimate(files) == [os.path.getsize(f) for f in files]
+        True
+
+    Once we have recorded the duration of some files, the estimation
+    of the rest is the size scaled by the average time per byte of the
+    files that we know:
+
+        >>> size = os.path.getsize('byexample/runner.py')
+        >>> history.record('byexample/runner.py', 2.0)
+
+        >>> costs = history.estimate(['byexample/runner.py', 'byexample/jobs.py'])
+        >>> costs[0]
+        2.0
+
+        >>> costs[1] == 2.0 * os.path.getsize('byexample/jobs.py') / size
+        True
+
+    The history is saved in disk only if a filename was given.
+
+    On save, the entries of the files that no longer exist are
+    dropped:
+
+        >>> name = 'doctest-history-%i' % os.getpid()
+        >>> history = History(name)
+
+        >>> history.record('byexample/jobs.py', 1.0)
+        >>> history.record('byexample/jobs.py:1-10', 1.0)     # a shard
+        >>> history.record('byexample/deleted.py', 1.0)
+        >>> history.save()
+
+        >>> history = History(name)
+        >>> [history.has_any([f]) for f in ('byexample/jobs.py',
+        ...                  'byexample/jobs.py:1-10', 'byexample/deleted.py')]
+        [True, True, False]
+
+    And so are the ones not recorded in the last <MAX_RUNS> runs, like
+    the shards of a file sharded differently:
+
+        >>> history.MAX_RUNS = 2
+        >>> for _ in range(2):
+        ...     history.record('byexample/runner.py', 1.0)
+        ...     history.save()
+
+        >>> history = History(name)
+        >>> history.has_any(['byexample/jobs.py']), history.has_any(['byexample/runner.py'])
+        (False, True)
+
+        >>> os.remove(history.filename)
+    '''
+    # how many runs (saves) an entry is kept without being recorded again
+    MAX_RUNS = 32
+
+    # the key of the number of runs saved so far
+    _RUNS_KEY = None
+
+    def _key(self, item):
+        # str(item) to support shards of files
+        return os.path.abspath(str(item))
+
+    def _size(self, item):
+        try:
+            return getattr(item, 'size', None) or os.path.getsize(item)
+        except OSError:
+            return 0
+
+    def record(self, item, elapsed):
+        ''' Record how long took to run <item>, a file or a shard of it. '''
+        key = self._key(item)
+        size = self._size(item)
+
+        self._entries[key] = self._recorded[key] = (elapsed, size)
+
+    def _merge(self, entries, recorded):
+        ''' Merge the <recorded> entries tagging them with the number
+            of this run and drop the ones of files that no longer exist
+            or that were not recorded in the last <MAX_RUNS> runs.
+            '''
+        run = entries.get(self._RUNS_KEY, 0) + 1
+        for key, (elapsed, size) in recorded.items():
+            entries[key] = (elapsed, size, run)
+
+        # entries saved by older versions of byexample do not have a run
+        pruned = {key: entry for key, entry in entries.items()
+                    if key is not self._RUNS_KEY
+                    and run - (entry[2] if len(entry) > 2 else 0) < self.MAX_RUNS
+                    and os.path.exists(self._filepath_of(key))}
+
+        pruned[self._RUNS_KEY] = run
+        return pruned
+
+    def _filepath_of(self, key):
+        # the key of a shard is <filepath>:<start>-<end>
+        m = re.match(r'^(.*):\d+-\d+$', key)
+        return m.group(1) if m else key
+
+    def estimate(self, items):
+        ''' Return the estimated cost of each item (in seconds if we
+            have some history, in bytes otherwise).
+            '''
+        sizes = [self._size(item) for item in items]
+
+        known = [self._entries.get(self._key(item)) for item in items]
+
+        total_elapsed = sum(k[0] for k in known if k)
+        total_size = sum(k[1] for k in known if k)
+        if not total_size or not total_elapsed:
+            total_elapsed = total_size = 1
+
+        return [k[0] if k else size * total_elapsed / total_size
+                    for k, size in zip(known, sizes)]
+
+    def has_any(self, items):
+        return any(self._key(item) in self._entries for item in items)
@@ -0,0 +1,208 @@
+from __future__ import unicode_literals
+import hashlib, os, time, shlex
+
+from .history import Store
+from .runner import ShebangTemplate
+from .common import log
+
+try:
+    from shutil import which as _which
+except ImportError:
+    # Python 2.7
+    from distutils.spawn import find_executable as _which
+
+def _hash_file(h, filepath, start_lineno=None, end_lineno=None):
+    ''' Update the hash <h> with the content of <filepath>, only
+        the lines from <start_lineno> to <end_lineno> if given. '''
+    try:
+        with open(filepath, 'rb') as f:
+            content = f.read()
+    except (IOError, OSError):
+        h.update(b'<missing>')
+        return
+
+    if start_lineno is not None:
+        lines = content.splitlines(True)
+        content = b''.join(lines[start_lineno-1:end_lineno])
+
+    h.update(content)
+
+def _binary_of(cmd):
+    ''' Return the program that the command line <cmd> runs: its first
+        word or, if it is run by env, the first word after the env's
+        options and variables. '''
+    words = shlex.split(cmd)
+    if words and os.path.basename(words[0]) == 'env':
+        words = words[1:]
+        while words and (words[0].startswith('-') or '=' in words[0]):
+            words = words[1:]
+
+    return words[0] if words else ''
+
+def interpreter_of(runner, shebangs):
+    ''' Return a string that identifies the interpreter used by the
+        <runner>: its command line and the path, size and modification
+        time of its binary (if we can find it).
+
+        The binary is the one that the shebang runs, the default or
+        the one set with -x-shebang:
+
+        >>> import os, shutil, tempfile
+        >>> from byexample.incremental import interpreter_of
+
+        >>> class Runner(object):
+        ...     language = 'python'
+        ...     def get_default_cmd(self, *args, **kargs):
+        ...         return '%e %p %a', {'e': '/usr/bin/env', 'p': 'python', 'a': ['-i']}
+
+        >>> tmpdir = tempfile.mkdtemp()
+        >>> binary = os.path.join(tmpdir, 'mypython')
+        >>> with open(binary, 'w') as f:
+        ...     _ = f.write('#!/bin/sh\n')
+        >>> os.chmod(binary, 0o755)
+
+        >>> shebangs = {'python': '%e ' + binary + ' %a'}
+        >>> before = interpreter_of(Runner(), shebangs)
+
+        >>> with open(binary, 'a') as f:
+        ...     _ = f.write('exec python "$@"\n')
+        >>> before == interpreter_of(Runner(), shebangs)
+        False
+
+        >>> shutil.rmtree(tmpdir)
+        '''
+    try:
+        shebang, tokens = runner.get_default_cmd(False, 80)
+    except Exception:
+        return repr(runner)
+
+    shebang = shebangs.get(runner.language, shebang)
+
+    try:
+        cmd = ShebangTemplate(shebang).quote_and_substitute(tokens)
+        binary = _which(_binary_of(cmd)) or ''
+    except (ValueError, KeyError):
+        # a malformed shebang: the interpreter will fail to start anyway
+        binary = ''
+
+    try:
+        st = os.stat(binary)
+        binary_id = '%s %i %i' % (binary, st.st_size, st.st_mtime)
+    except OSError:
+        binary_id = binary
+
+    return '%s %s %s' % (shebang, tokens, binary_id)
+
+def environment_signature(args, runners, version):
+    ''' Return a hash of all the things, except the files themselves,
+        that may change the result of running a file: the command line
+        options that affect the execution, the byexample <version>,
+        the interpreters of the <runners> and the content of the
+        dependency files (--depends-on). '''
+    h = hashlib.sha1()
+    h.update(version.encode('utf-8'))
+
+    for name in ('languages', 'options_str', 'timeout', 'shebangs',
+                 'encoding', 'modules_dirs', 'shard_at'):
+        h.update(repr((name, getattr(args, name, None))).encode('utf-8'))
+
+    for name, value in sorted(vars(args).items()):
+        if name.startswith('x_'):
+            h.update(repr((name, value)).encode('utf-8'))
+
+    shebangs = dict(args.shebangs)
+    for runner in sorted(runners, key=lambda r: r.language):
+        h.update(interpreter_of(runner, shebangs).encode('utf-8'))
+
+    for filepath in sorted(args.depends_on):
+        h.update(filepath.encode('utf-8'))
+        _hash_file(h, filepath)
+
+    return h.hexdigest()
+
+class ResultStore(Store):
+    r'''
+    Remember which files passed in the past so we do not run them
+    again if nothing changed.
+
+    A file is identified by a hash of its content and of the environment
+    (see environment_signature): if any of them changes, the file is
+    run again.
+
+        >>> from byexample.incremental import ResultStore
+        >>> store = ResultStore(None, 'env-A')
+
+        >>> files = ['byexample/jobs.py', 'byexample/runner.py']
+        >>> store.split_cached(files)
+        (['byexample/jobs.py', 'byexample/runner.py'], [])
+
+    Only the files that passed are recorded:
+
+        >>> store.record('byexample/jobs.py', 1.0, (False, False, False, False))
+        >>> store.record('byexample/runner.py', 1.0, (True, False, False, False))
+
+        >>> store.split_cached(files)
+        (['byexample/runner.py'], ['byexample/jobs.py'])
+
+    A different environment means that nothing is cached:
+
+        >>> ResultStore(None, 'env-B').split_cached(files)
+        (['byexample/jobs.py', 'byexample/runner.py'], [])
+
+    The results are saved in disk only if a filename was given.
+    '''
+    def __init__(self, filename, signature):
+        Store.__init__(self, filename)
+        self.signature = signature
+        self._keys = {}
+
+    def _key(self, item):
+        item_str = str(item)
+        try:
+            return self._keys[item_str]
+        except KeyError:
+            pass
+
+        h = hashlib.sha1(self.signature.encode('utf-8'))
+        h.update(os.path.abspath(item_str).encode('utf-8'))
+
+        # item can be a file or a shard of it
+        filepath = getattr(item, 'filepath', item)
+        _hash_file(h, filepath, getattr(item, 'start_lineno', None),
+                                getattr(item, 'end_lineno', None))
+
+        key = self._keys[item_str] = h.hexdigest()
+        return key
+
+    def split_cached(self, items):
+        ''' Return the items that need to be run and the ones that
+            passed before with the same content and environment. '''
+        to_run, cached = [], []
+        for item in items:
+            if self._key(item) in self._entries:
+                cached.append(item)
+            else:
+                to_run.append(item)
+
+        return to_run, cached
+
+    def record(self, item, elapsed, result, complete=True):
+        ''' Record the <item> if it passed. '''
+        if complete and not any(result):
+            key = self._key(item)
+            self._entries[key] = self._recorded[key] = time.time()
+
+    def finish(self):
+        pass
+
+def skip_cached(store, items, verbosity, quiet):
+    ''' Return the items that are not cached in the <store>,
+        reporting the ones that are. '''
+    to_run, cached = store.split_cached(items)
+
+    if not quiet:
+        for item in cached:
+            log("File %s, cached: it passed before with the same content and environment." % item,
+                    verbosity)
+
+    return to_run
@@ -8,6 +8,8 @@ from .executor import FileExecutor
 from .differ import Differ
 from .parser import ExampleParser
 from .concern import Concern, ConcernComposite
+from .shard import shard_files
+from .jobs import auto_jobs, plan_jobs
 from .common import log
 
 def are_tty_colors_supported(output):
@@ -167,6 +169,14 @@ def get_default_options_parser(cmdline_args):
             "skip",
             default=False,
             help="do not run the example.")
+    options_parser.add_flag(
+            "block",
+            default=False,
+            help="send the whole example to the interpreter at once instead of line by line (only some languages support this).")
+    options_parser.add_flag(
+            "frame",
+            default=False,
+            help="find the end of the example's output by a random marker printed after it instead of by the prompts (only some languages support this).")
     options_parser.add_flag(
             "tags",
             default=True,
@@ -200,6 +210,11 @@ def get_default_options_parser(cmdline_args):
             default='dumb',
             choices=['as-is', 'dumb', 'ansi'],
             help="select a terminal emulator to interpret the output (default to 'dumb').")
+    options_parser.add_argument(
+            "+transport",
+            default='pty',
+            choices=['pty', 'pipe'],
+            help="connect with the interpreters with a pseudo terminal or with pipes, cheaper but without a terminal (only some languages support this; default to 'pty').")
 
     return options_parser
 
@@ -323,8 +338,19 @@ def init(args):
     allowed_files = set(args.files) - set(args.skip)
     testfiles = list(sorted(f for f in args.files if f in allowed_files))
 
-    # Do not spawn more jobs than testfiles
-    args.jobs = cfg['jobs'] = min(args.jobs, len(testfiles))
+    # split the files in shards (if the user wants) *before* limiting
+    # the count of jobs so a single huge file can use more than one job
+    if args.shard_at:
+        testfiles = shard_files(testfiles, args.shard_at, encoding, args.verbosity)
+
+    if args.jobs == 'auto':
+        args.jobs = auto_jobs(args.verbosity)
+
+    # how many files can be run at the same time; the jobs are planned
+    # again once we know what files we need to run so this is an upper
+    # bound (see plan_jobs)
+    njobs, nslots = plan_jobs(args.jobs, args.x_files_per_job, len(testfiles))
+    cfg['jobs'] = njobs * nslots
 
     options = get_options(args, cfg)
 
@@ -361,6 +387,18 @@ def init(args):
     log("Configuration:\n%s." % pprint.pformat(cfg), cfg['verbosity']-2)
     log("Registry:\n%s." % pprint.pformat(registry), cfg['verbosity']-2)
 
+    harvester, executor = build_harvester_and_executor(cfg, registry,
+                                                            allowed_languages)
+
+    def new_slot():
+        slot_cfg = dict(cfg, options=cfg['options'].copy())
+        return build_harvester_and_executor(slot_cfg,
+                                    renew_registry(registry, slot_cfg),
+                                    allowed_languages)
+
+    return testfiles, harvester, executor, options, new_slot
+
+def build_harvester_and_executor(cfg, registry, allowed_languages):
     concerns = ConcernComposite(registry, **cfg)
 
     differ = Differ(**cfg)
@@ -368,4 +406,43 @@ def init(args):
     harvester = ExampleHarvest(allowed_languages, registry, **cfg)
     executor  = FileExecutor(concerns, differ, **cfg)
 
-    return testfiles, harvester, executor, options
+    return harvester, executor
+
+def renew_registry(registry, cfg):
+    ''' Return a registry like <registry> but with new instances of
+        its runners, parsers, finders, zone delimiters and concerns
+        (built from <cfg>) so they can be used at the same time than
+        the originals (see -x-files-per-job).
+
+        An object registered under several keys is still a single
+        (new) object.
+
+            >>> from byexample.init import renew_registry
+            >>> class Runner(object):
+            ...     built = 0
+            ...     def __init__(self, **cfg):
+            ...         Runner.built += 1
+            ...         self.cfg = cfg
+
+            >>> runner = Runner()
+            >>> registry = {'runners': {'python': runner, 'py': runner},
+            ...             'concerns': {}}
+
+            >>> new = renew_registry(registry, {'verbosity': 2})
+            >>> python, py = new['runners']['python'], new['runners']['py']
+            >>> python is py, python is runner, Runner.built
+            (True, False, 2)
+
+            >>> python.cfg
+            {'verbosity': 2}
+        '''
+    renewed = {}
+    new_registry = {}
+    for what, container in registry.items():
+        new_registry[what] = {}
+        for key, obj in container.items():
+            if id(obj) not in renewed:
+                renewed[id(obj)] = type(obj)(**cfg)
+            new_registry[what][key] = renewed[id(obj)]
+
+    return new_registry
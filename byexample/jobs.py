@@ -1,6 +1,13 @@
 from __future__ import unicode_literals
-from multiprocessing import Queue, Process
-import signal, contextlib
+from multiprocessing import Queue, Process, Event
+import multiprocessing, threading, signal, contextlib, collections, heapq, time, os
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty # Python 2.7
+
+from .common import log
 
 class Status:
     ok = 0
@@ -8,69 +15,656 @@ class Status:
     aborted = 2
     error = 3
 
-def worker(func, sigint_handler, input, output):
+def worker(func, sigint_handler, input, output, teardown=None,
+                slots=1, setup_slot=None, cancelled=None):
     ''' Generic worker: call <func> for each item pulled from
         the <input> queue until a None gets pulled.
 
         For each result obtained from calling <func>, push the
-        result into <output> queue.
+        item, the time that took to process it and the result
+        into <output> queue.
+
+        After receiving a None, call <teardown> (if any) and
+        close the <output> queue.
 
-        After receiving a None, close the <output> queue.
+        With <slots> greater than 1, process up to <slots> items at the
+        same time (see slotted_worker).
         '''
-    for item in iter(input.get, None):
-        output.put(func(item, sigint_handler))
+    try:
+        if slots > 1:
+            slotted_worker(func, input, output, slots, setup_slot, cancelled)
+        else:
+            for item in iter(input.get, None):
+                begin = time.time()
+                result = func(item, sigint_handler)
+                output.put((item, time.time() - begin, result))
+    finally:
+        if teardown is not None:
+            teardown()
     output.close()
     output.join_thread()
 
+# the number of the job of the current thread if it is a slot
+# (see job_number)
+_slot = threading.local()
+
+# how many jobs are running, counting each slot as a job
+# (see job_count)
+_njobs = 1
+
+def job_number():
+    ''' Return the number of the job (counting from 0) that is running
+        the caller: the number of its worker or, if the worker has
+        slots, the number of the slot (unique among all the workers).
+        '''
+    number = getattr(_slot, 'number', None)
+    if number is None:
+        number = int(multiprocessing.current_process().name)
+    return number
+
+def job_count():
+    ''' Return how many jobs are running, counting each slot of a
+        worker as a job: the numbers returned by job_number are lower
+        than this. '''
+    return _njobs
+
+def plan_jobs(njobs, slots, nitems):
+    ''' Return how many jobs and how many slots per job (see
+        slotted_worker) we should use to process <nitems> items with
+        at most <njobs> jobs of <slots> slots each.
+
+        Do not spawn more jobs than items:
+
+            >>> from byexample.jobs import plan_jobs
+            >>> plan_jobs(4, 1, 2)
+            (2, 1)
+
+        Nor more slots than what the jobs can fill:
+
+            >>> plan_jobs(2, 4, 5)
+            (2, 3)
+            >>> plan_jobs(2, 4, 16)
+            (2, 4)
+        '''
+    njobs = max(min(njobs, nitems), 1)
+    slots = max(min(slots, -(-nitems // njobs)), 1)
+    return njobs, slots
+
+def slotted_worker(func, input, output, slots, setup_slot, cancelled):
+    ''' Process up to <slots> items at the same time, each one in its
+        own thread (a slot), until all of them pull a None from the
+        <input> queue.
+
+        Most of the time of a worker is spent waiting for the
+        interpreters so the slots of a worker can keep more than one
+        interpreter busy.
+
+        Each slot calls <setup_slot> with its number (from 0) before
+        pulling any item; if it returns False, the slot is not used.
+
+        Only the main thread can handle the signals so <func> is called
+        with None as its sigint_handler: a ctrl-c sets the <cancelled>
+        event of the items in progress (see Jobs.cancel_workers) and
+        their results are marked as user aborted.
+
+        Let's run a worker with 2 slots; each item waits for the other
+        so they are processed at the same time or they fail:
+
+            >>> import threading, time
+            >>> from multiprocessing import Process, Queue
+            >>> from byexample.jobs import worker, job_number
+
+            >>> cond, arrived = threading.Condition(), []
+            >>> def func(item, sigint_handler):
+            ...     with cond:
+            ...         arrived.append(item)
+            ...         cond.notify_all()
+            ...         deadline = time.time() + 1
+            ...         while len(arrived) < 2 and time.time() < deadline:
+            ...             cond.wait(0.1)
+            ...     return len(arrived) < 2, job_number()
+
+            >>> def run(items, setup_slot=None):
+            ...     input, output = Queue(), Queue()
+            ...     p = Process(target=worker, name='0',
+            ...             args=(func, None, input, output, None, 2, setup_slot, None))
+            ...     p.start()
+            ...     for item in items + [None, None]:   # a None per slot
+            ...         input.put(item)
+            ...     results = sorted((output.get(timeout=10) for _ in items),
+            ...                         key=lambda r: r[0])
+            ...     p.join(10)
+            ...     return [(item, result) for item, _, result in results], p.is_alive()
+
+            >>> results, alive = run(['a', 'b'])
+            >>> sorted(failed for _, (failed, _) in results), alive
+            ([False, False], False)
+
+        A slot whose <setup_slot> fails is not used: the other slot
+        processes all the items, one by one:
+
+            >>> results, alive = run(['a', 'b'], setup_slot=lambda number: number == 0) # byexample: +timeout=10
+            >>> [(item, slot) for item, (_, slot) in results], alive
+            ([('a', 0), ('b', 0)], False)
+
+        The worker stops once all its slots pulled a None (see
+        Jobs.stop_workers).
+        '''
+    base = job_number() * slots
+    interrupted = threading.Event()
+
+    def slot(number):
+        _slot.number = base + number
+        if setup_slot is not None and setup_slot(number) is False:
+            return
+
+        for item in iter(input.get, None):
+            begin = time.time()
+            result = func(item, None)
+            if interrupted.is_set():
+                failed, aborted, user_aborted, error = result
+                result = (failed, aborted, True, error)
+            output.put((item, time.time() - begin, result))
+
+    def on_sigint(signum, frame):
+        interrupted.set()
+        if cancelled is not None:
+            cancelled.set()
+
+    threads = [threading.Thread(target=slot, args=(n, ), name='slot-%i' % n)
+                    for n in range(slots)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    with allow_sigint(on_sigint):
+        # join with a timeout so the signals are handled meanwhile
+        for t in threads:
+            while t.is_alive():
+                t.join(0.5)
+
+def makespan(costs, njobs):
+    ''' Simulate how <njobs> workers would process the items
+        with the given <costs> (in that order): each free worker
+        takes the next item.
+
+        Return the time when the last worker finishes.
+
+            >>> from byexample.jobs import makespan
+            >>> makespan([1, 1, 1, 4], 2)
+            5
+            >>> makespan([4, 1, 1, 1], 2)
+            4
+        '''
+    workers = [0] * njobs
+    for cost in costs:
+        heapq.heappush(workers, heapq.heappop(workers) + cost)
+
+    return max(workers)
+
+def longest_first(items, costs):
+    ''' Sort the items from the most to the least expensive
+        (aka Longest Processing Time first).
+
+        Items with the same cost keep their relative order.
+
+            >>> from byexample.jobs import longest_first
+            >>> longest_first(['a', 'b', 'c', 'd'], [1, 3, 1, 2])
+            (['b', 'd', 'a', 'c'], [3, 2, 1, 1])
+        '''
+    order = sorted(range(len(items)), key=lambda i: -costs[i])
+    return [items[i] for i in order], [costs[i] for i in order]
+
+# estimated memory used by a worker and its interpreters
+MEMORY_PER_JOB = 128 * 1024 * 1024
+
+def _read_first_line(filename):
+    try:
+        with open(filename, 'r') as f:
+            return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+def cgroup_cpu_quota():
+    ''' Return how many CPUs we are allowed to use based on the
+        CPU quota of our cgroup (v2 or v1) or None if there is no quota.
+        '''
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    line = _read_first_line('/sys/fs/cgroup/cpu.max')
+    if line:
+        quota, period = (line.split() + ['100000'])[:2]
+    else:
+        # cgroup v1: quota is -1 if there is no limit
+        quota = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+
+    try:
+        quota, period = int(quota), int(period)
+    except (TypeError, ValueError):
+        return None
+
+    if quota <= 0 or period <= 0:
+        return None
+
+    return float(quota) / period
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+def available_memory():
+    ''' Return the memory available in bytes or None if unknown. '''
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+
+    return None
+
+def load_average():
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return 0
+
+def auto_jobs_from(ncpus, quota, loadavg, memory):
+    r''' Return how many jobs we should spawn and the reasoning behind it.
+
+        We use the CPUs not in use (see <loadavg>) from the <ncpus> CPUs
+        we have or from the CPU <quota> if it is lower.
+
+        Because each job drives at least one interpreter, a job demands
+        about two CPUs.
+
+            >>> from byexample.jobs import auto_jobs_from, MEMORY_PER_JOB
+            >>> njobs, reasons = auto_jobs_from(8, None, 0, None)
+            >>> njobs
+            4
+            >>> print('\n'.join(reasons))
+            8 CPUs available
+            2 CPUs per job (the worker and its interpreter): 4 jobs
+
+        The jobs are limited by the cgroup quota, the current load
+        and by the available <memory>:
+
+            >>> njobs, reasons = auto_jobs_from(8, 2.5, 0.5, 2 * MEMORY_PER_JOB)
+            >>> njobs
+            1
+            >>> print('\n'.join(reasons))
+            8 CPUs available
+            cgroup CPU quota of 2.50 CPUs
+            load average of 0.50: 2.00 CPUs free
+            2 CPUs per job (the worker and its interpreter): 1 jobs
+            memory available for 2 jobs
+
+        There is always at least one job.
+
+            >>> auto_jobs_from(8, None, 16, None)[0]
+            1
+        '''
+    reasons = ["%i CPUs available" % ncpus]
+    cpus = float(ncpus)
+    if quota is not None and quota < cpus:
+        cpus = quota
+        reasons.append("cgroup CPU quota of %0.2f CPUs" % quota)
+
+    if loadavg > 0:
+        cpus = max(cpus - loadavg, 1)
+        reasons.append("load average of %0.2f: %0.2f CPUs free" % (loadavg, cpus))
+
+    njobs = max(int(cpus // 2), 1)
+    reasons.append("2 CPUs per job (the worker and its interpreter): %i jobs" % njobs)
+
+    if memory is not None:
+        by_memory = max(int(memory // MEMORY_PER_JOB), 1)
+        reasons.append("memory available for %i jobs" % by_memory)
+        njobs = min(njobs, by_memory)
+
+    return njobs, reasons
+
+def auto_jobs(verbosity):
+    ''' Return how many jobs we should spawn based on the CPUs, memory
+        and load of the system (see auto_jobs_from). '''
+    njobs, reasons = auto_jobs_from(available_cpus(), cgroup_cpu_quota(),
+                                        load_average(), available_memory())
+
+    log("Jobs: %i (%s)." % (njobs, '; '.join(reasons)), verbosity-1)
+    return njobs
+
+class Admission(object):
+    r'''
+    Decide if an item can be started now or if it should wait.
+
+    An item is held back if starting it would exceed the limit of
+    items running concurrently for any of its languages (<max_concurrent>)
+    or if the available memory is below <min_free_memory> (in bytes).
+
+        >>> from byexample.jobs import Admission
+        >>> languages = {'a.md': {'cpp'}, 'b.md': {'cpp', 'shell'}, 'c.md': {'shell'}}
+        >>> admission = Admission(languages.get, {'cpp': 1}, 0, 0)
+
+        >>> admission.can_start('a.md')
+        True
+        >>> admission.start('a.md')
+
+        >>> admission.can_start('b.md'), admission.can_start('c.md')
+        (False, True)
+
+        >>> admission.finish('a.md')
+        >>> admission.can_start('b.md')
+        True
+
+    Anything can be started if nothing is running, otherwise we may wait
+    forever.
+
+    The available memory is not read on each can_start call but it is
+    sampled calling sample().
+    '''
+    def __init__(self, languages_of, max_concurrent, min_free_memory, verbosity):
+        self.languages_of = languages_of
+        self.max_concurrent = max_concurrent
+        self.min_free_memory = min_free_memory
+        self.verbosity = verbosity
+
+        self.running = collections.Counter()
+        self.nrunning = 0
+
+        # last sample of the available memory (see sample)
+        self.memory = None
+
+    def _languages_of(self, item):
+        return self.languages_of(item) or ()
+
+    def key_of(self, item):
+        ''' Return the key of the <item>: items with the same key
+            are admitted or held back together. '''
+        return frozenset(self._languages_of(item))
+
+    def sample(self):
+        ''' Read the available memory, if we need it. '''
+        if self.min_free_memory:
+            self.memory = available_memory()
+
+    def can_start(self, item):
+        if self.nrunning == 0:
+            return True
+
+        for language in self._languages_of(item):
+            limit = self.max_concurrent.get(language)
+            if limit is not None and self.running[language] >= limit:
+                log("Scheduler: holding back %s (%i %s running)." % (
+                            item, self.running[language], language),
+                            self.verbosity-2)
+                return False
+
+        if self.min_free_memory:
+            memory = self.memory
+            if memory is not None and memory < self.min_free_memory:
+                log("Scheduler: holding back %s (%i MB of free memory)." % (
+                            item, memory // (1024*1024)),
+                            self.verbosity-2)
+                return False
+
+        return True
+
+    def start(self, item):
+        self.nrunning += 1
+        self.running.update(self._languages_of(item))
+
+    def finish(self, item):
+        self.nrunning -= 1
+        self.running.subtract(self._languages_of(item))
+
+    def needs_polling(self):
+        ''' The available memory may change at any moment so we must
+            check it from time to time. '''
+        return bool(self.min_free_memory)
+
+class PendingItems(object):
+    r'''
+    The items waiting to be sent to the workers, in order.
+
+    The items are kept in one queue per <key> so finding the first item
+    that can be started checks only the first item of each queue
+    instead of all the items.
+
+        >>> from byexample.jobs import PendingItems
+        >>> items = PendingItems(['a.cpp', 'b.py', 'c.cpp', 'd.py'],
+        ...                      key=lambda item: item.split('.')[1])
+        >>> len(items)
+        4
+
+        >>> items.popleft(lambda item: not item.endswith('.cpp'))
+        'b.py'
+        >>> items.popleft()
+        'a.cpp'
+        >>> items.popleft(lambda item: False) is None
+        True
+
+        >>> len(items)
+        2
+        >>> items.clear()
+        >>> bool(items)
+        False
+
+    Without a <key> all the items are in the same queue.
+    '''
+    def __init__(self, items, key=None):
+        self.queues = collections.OrderedDict()
+        self.n = 0
+        for seq, item in enumerate(items):
+            k = None if key is None else key(item)
+            self.queues.setdefault(k, collections.deque()).append((seq, item))
+            self.n += 1
+
+    def __len__(self):
+        return self.n
+
+    def clear(self):
+        self.queues.clear()
+        self.n = 0
+
+    def popleft(self, can_start=None):
+        ''' Pop the first item for which <can_start> returns True
+            or return None if there is none.
+
+            Only the first item of each queue is checked: if it cannot
+            be started, neither can the rest of its queue. '''
+        first = None
+        for k, queue in self.queues.items():
+            seq, item = queue[0]
+            if (first is None or seq < first[0]) and \
+                    (can_start is None or can_start(item)):
+                first = seq, k
+
+        if first is None:
+            return None
+
+        k = first[1]
+        queue = self.queues[k]
+        _, item = queue.popleft()
+        if not queue:
+            del self.queues[k]
+
+        self.n -= 1
+        return item
+
 class Jobs(object):
-    def __init__(self, njobs, verbosity):
+    def __init__(self, njobs, verbosity, history=None, observers=(), admission=None,
+                        slots=1):
         self.njobs = njobs
         self.verbosity = verbosity
 
-    def spawn_jobs(self, func, items):
+        # how many items each job processes at the same time
+        # (see slotted_worker)
+        self.slots = slots
+        self.history = history
+
+        # decide which item can be started (see Admission)
+        self.admission = admission
+
+        # objects notified of each result (record) and of the
+        # end of the loop (finish)
+        self.observers = observers
+
+        # set when the workers must stop as soon as possible
+        # (see cancel_workers)
+        self.cancelled = Event()
+
+    def schedule(self, items):
+        ''' Return the <items> sorted in the order that they should
+            be processed.
+
+            If we have a history of how long took each item in the past,
+            send the longest first so no worker ends up processing a long
+            item at the end while the rest are idle.
+
+            The order is not changed if there is only one job with
+            a single slot (it would not make any difference) or if there
+            is no history.
+            '''
+        nslots = self.njobs * self.slots
+        if nslots <= 1 or self.history is None:
+            return items
+
+        costs = self.history.estimate(items)
+        lpt_items, lpt_costs = longest_first(items, costs)
+
+        if not self.history.has_any(items):
+            log("Scheduler: no history found, running the largest files first.",
+                    self.verbosity-1)
+            return lpt_items
+
+        before = makespan(costs, nslots)
+        after = makespan(lpt_costs, nslots)
+        log("Scheduler: estimated run of %0.2f seconds (%0.2f seconds in the given order); idle time saved: %0.2f seconds." % (
+                    after, before, (before - after) * nslots),
+                    self.verbosity-1)
+
+        return lpt_items
+
+    def spawn_jobs(self, func, items, teardown=None, setup_slot=None):
         ''' Spawn <njobs> jobs to process <items> in parallel/concurrently.
 
             The processes are started and feeded with the first <njobs> items
-            in <items>, the rest of them need to be pushed manually
-            calling send_next_item_from; the result of each file processed can
-            be fetched from the <output>.
+            in <items> (see send_items_from), the rest of them need to be pushed
+            manually calling send_items_from; the result of each file processed
+            can be fetched from the <output>.
+
+            Each process calls <teardown> (if any) before finishing and,
+            if it has more than one slot, each slot calls <setup_slot>
+            before starting (see slotted_worker).
 
-            Return the <rest> of the <items> not sent,
+            Return the <rest> of the <items> not sent (see PendingItems),
             and the <output> queue.
             '''
+        global _njobs
         njobs = self.njobs
         assert njobs <= len(items)
 
+        # the workers inherit this (see job_count)
+        _njobs = njobs * self.slots
+
         self.sigint_handler = self.ignore_sigint()
+        self.sigusr1_handler = self.ignore_sigusr1()
 
         self.input = Queue()
         self.output = Queue()
 
         self.processes = [Process(target=worker, name=str(n),
-                                             args=(func, self.sigint_handler, self.input, self.output))
+                                             args=(func, self.sigint_handler, self.input, self.output, teardown,
+                                                    self.slots, setup_slot, self.cancelled))
                                              for n in range(njobs)]
         for p in self.processes:
             p.start()
 
-        # feed the workers with enough data so all of them can start to work
-        for item in items[:njobs]:
-            self.input.put(item)
-
         if self.verbosity >= 1:
             for p in self.processes:
                 print("Worker %s (PID %i)." % (p.name, p.pid))
 
-        return items[njobs:]
+        # feed the workers with enough data so all of them can start to work
+        self.idle = njobs * self.slots
+        key = None if self.admission is None else self.admission.key_of
+        rest = PendingItems(items, key)
+        self.send_items_from(rest)
+
+        return rest
 
     def ignore_sigint(self):
         return signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-    def send_next_item_from(self, rest):
-        self.input.put(rest[0])
-        del rest[0]
+    def ignore_sigusr1(self):
+        ''' Ignore SIGUSR1 (and make the workers to inherit this) so
+            a worker will not die if it receives the signal sent by
+            cancel_workers while it is not ready to handle it.
+
+            A handler that does nothing is used instead of SIG_IGN: an
+            ignored signal would be ignored by the interpreters spawned
+            by the workers too while a handled one is reset on exec.
+            '''
+        return signal.signal(signal.SIGUSR1, _ignore_signal)
+
+    def cancel_workers(self):
+        ''' Ask to the workers to stop whatever they are doing: set
+            the <cancelled> event, checked by the workers between
+            item and item, and send them a SIGUSR1 to interrupt
+            any ongoing work (if the worker supports that).
+            '''
+        self.cancelled.set()
+        for p in self.processes:
+            try:
+                os.kill(p.pid, signal.SIGUSR1)
+            except OSError:
+                pass # already dead
+
+    def _pop_next_item_from(self, rest):
+        ''' Pop the first item in <rest> that can be started now or
+            return None if there is none. '''
+        if self.admission is None:
+            return rest.popleft()
+
+        item = rest.popleft(self.admission.can_start)
+        if item is not None:
+            self.admission.start(item)
+
+        return item
+
+    def send_items_from(self, rest):
+        ''' Send items from <rest> to the idle workers, as many as
+            possible. '''
+        if self.admission is not None:
+            self.admission.sample()
+
+        while self.idle and rest:
+            item = self._pop_next_item_from(rest)
+            if item is None:
+                break
+
+            self.input.put(item)
+            self.idle -= 1
 
     def stop_workers(self):
-        for _ in range(self.njobs):
+        r''' Send a None to each slot of each worker so all of them stop
+            (see slotted_worker).
+
+                >>> from byexample.jobs import Jobs
+                >>> class FakeQueue(list):
+                ...     put = list.append
+                ...     def close(self): pass
+
+                >>> jobs = Jobs(2, 0, slots=3)
+                >>> jobs.input = FakeQueue()
+
+                >>> jobs.stop_workers()
+                >>> jobs.input.count(None)
+                6
+            '''
+        for _ in range(self.njobs * self.slots):
             self.input.put(None)
         self.input.close()
 
@@ -81,6 +675,8 @@ class Jobs(object):
         for p in self.processes:
             p.join()
 
+        signal.signal(signal.SIGUSR1, self.sigusr1_handler)
+
     def loop(self, nitems, rest, fail_fast):
         ''' Loop <nitems> times fetching from <output> the
             result of each processed file done in background.
@@ -92,15 +688,41 @@ class Jobs(object):
             return the exit status (see Status).
 
             Cancel the loop earlier if a run fails and <fail_fast>
-            is True (keep in mind that because several jobs are running
-            in background, it is possible that some extra files gets
-            processed before closing the loop).
+            is True: the rest of the workers are cancelled too (see
+            cancel_workers) but keep in mind that because several jobs
+            are running in background, it is possible that some extra
+            examples get executed before closing the loop.
             '''
         exit_status = Status.ok
         end_sentinels_sent = False
+        begin = time.time()
+        busy = 0
         while nitems:
-            failed, aborted, user_aborted, error = self.output.get()
+            try:
+                item, elapsed, result = self.output.get(timeout=self._poll_timeout(rest))
+            except Empty:
+                # some workers are waiting, check if we can send them
+                # something now
+                self.send_items_from(rest)
+                continue
+
+            failed, aborted, user_aborted, error = result
             nitems -= 1
+            busy += elapsed
+
+            self.idle += 1
+            if self.admission is not None:
+                self.admission.finish(item)
+
+            # the items processed after a cancellation may had not
+            # been processed completely
+            complete = not self.cancelled.is_set()
+
+            if self.history is not None and complete and not (user_aborted or error):
+                self.history.record(item, elapsed)
+
+            for observer in self.observers:
+                observer.record(item, elapsed, result, complete)
 
             if failed:
                 exit_status = max(exit_status, Status.failed)
@@ -113,27 +735,62 @@ class Jobs(object):
 
             if ((failed or aborted) and fail_fast) or user_aborted or error:
                 nitems -= len(rest)
-                rest = []
+                rest.clear()
+
+                # do not wait for the files in progress: stop the rest
+                # of the workers as soon as possible
+                if fail_fast and not self.cancelled.is_set():
+                    self.cancel_workers()
 
             if rest:
-                self.send_next_item_from(rest)
+                self.send_items_from(rest)
 
             if not rest and not end_sentinels_sent:
                 end_sentinels_sent = True
                 self.stop_workers()
 
         self.join_jobs()
+
+        for observer in self.observers:
+            observer.finish()
+
+        wall = time.time() - begin
+        nslots = self.njobs * self.slots
+        log("Scheduler: %i workers busy %0.2f seconds in a run of %0.2f seconds (%0.2f seconds idle)." % (
+                    nslots, busy, wall, max(wall * nslots - busy, 0)),
+                    self.verbosity-1)
         return exit_status
 
-    def run(self, func, items, fail_fast):
+    def _poll_timeout(self, rest):
+        ''' Block until the next result unless there are items held
+            back that may be started once the conditions change. '''
+        if self.idle and rest and self.admission is not None \
+                and self.admission.needs_polling():
+            return 0.5
+
+        return None
+
+    def run(self, func, items, fail_fast, teardown=None, setup_slot=None):
         ''' Process all the <items> in background, aborting earlier
             if one fails and <fail_fast> is True (see loop()).
+
+            The items are processed in the order given by schedule().
             '''
-        rest = self.spawn_jobs(func, items)
+        items = self.schedule(items)
+        rest = self.spawn_jobs(func, items, teardown, setup_slot)
         return self.loop(len(items), rest, fail_fast)
 
+def _ignore_signal(signum, frame):
+    pass
+
 @contextlib.contextmanager
 def allow_sigint(handler):
+    if handler is None:
+        # running in a slot, only the main thread can handle
+        # the signals (see slotted_worker)
+        yield
+        return
+
     try:
         signal.signal(signal.SIGINT, handler)
         yield
@@ -2,6 +2,7 @@ from __future__ import unicode_literals
 import traceback, time, os, sys, multiprocessing
 from byexample.common import colored, highlight_syntax, indent
 from byexample.concern import Concern
+from byexample.jobs import job_number, job_count
 
 try:
     from tqdm import tqdm
@@ -11,22 +12,21 @@ except ImportError:
 
 stability = 'provisional'
 
-class _DummyLock(object):
-    def __enter__(self):
-        return
-    def __exit__(self, *args):
-        pass
+# the lock shared by all the jobs (and slots) to write to the output
+_write_lock = None
 
-    def acquire(self, *args, **kargs):
-        pass
-
-    def release(self, *args, **kargs):
-        pass
+def _shared_write_lock():
+    global _write_lock
+    if _write_lock is None:
+        _write_lock = multiprocessing.RLock()
+    return _write_lock
 
 class SimpleReporter(Concern):
     target = None # progress
 
-    def __init__(self, verbosity, encoding, jobs, **unused):
+    # <jobs> is not used: the count of jobs is known once they are
+    # spawned (see job_count)
+    def __init__(self, verbosity, encoding, jobs=None, **unused):
         if 'use_progress_bar' in unused and unused['use_progress_bar'] \
                 and progress_bar_available:
             self.target = None # disable ourselves
@@ -37,11 +37,9 @@ class SimpleReporter(Concern):
         self.use_colors = unused['use_colors']
         self.verbosity = verbosity
 
-        self.jobs = jobs
-        if self.jobs != 1:
-            self.write_lock = multiprocessing.RLock()
-        else:
-            self.write_lock = _DummyLock()
+        # we do not know yet how many jobs will write to the output
+        # (see job_count)
+        self.write_lock = _shared_write_lock()
 
         self.header_printed = False
 
@@ -61,6 +59,8 @@ class SimpleReporter(Concern):
         self.begin = time.time()
 
         self.fail = self.good = self.skipped = 0
+        self.was_aborted = False
+        self.current_example = None
 
     def finish(self, failed, user_aborted, crashed, broken, timedout):
         if self.num_examples == 0:
@@ -84,7 +84,7 @@ class SimpleReporter(Concern):
 
         ran_number = self.examplenro
         tot_number = self.num_examples
-        if user_aborted or crashed or broken or timedout:
+        if user_aborted or crashed or broken or timedout or self.was_aborted:
             status_str = colored("[ABORT]", 'red', self.use_colors)
         elif failed:
             status_str = colored("[FAIL]", 'red', self.use_colors)
@@ -100,9 +100,17 @@ class SimpleReporter(Concern):
         self._write(msg)
 
     def skip_example(self, example, options):
+        # an example interrupted by a cancellation is skipped after
+        # being started: do not count it twice
+        if example is not self.current_example:
+            self.examplenro += 1
         self.skipped += 1
 
     def start_example(self, example, options):
+        # count the examples when they are run and not when they are
+        # parsed: the parse may happen ahead (see FileExecutor._pipeline)
+        self.examplenro += 1
+        self.current_example = example
         self.current_merged_flags = options
 
     def start_interact(self, example, options):
@@ -133,6 +141,8 @@ class SimpleReporter(Concern):
         self.fail += 1
 
     def aborted(self, example, by_the_user, options):
+        self.was_aborted = True
+
         msg = '\n'
         msg += self._error_header(example)
 
@@ -161,16 +171,14 @@ class SimpleReporter(Concern):
     def start_parse(self, example, options):
         self.header_printed = False
         self.current_parsing_example = example
-        self.finish_parse_called = False
 
     def finish_parse(self, example, options, exception):
-        if not self.finish_parse_called:
-            self.examplenro += 1
-            self.finish_parse_called = True
-
         if exception == None:
             return
 
+        # the example will not be run, count it here
+        self.examplenro += 1
+
         msg = '\n'
         msg += self._error_header(self.current_parsing_example)
 
@@ -260,7 +268,7 @@ class SimpleReporter(Concern):
 class ProgressBarReporter(SimpleReporter):
     target = None # progress
 
-    def __init__(self, verbosity, encoding, jobs, **unused):
+    def __init__(self, verbosity, encoding, jobs=None, **unused):
         SimpleReporter.__init__(self, verbosity, encoding, jobs, **unused)
         if ('use_progress_bar' in unused and not unused['use_progress_bar']) \
                 or not progress_bar_available:
@@ -281,7 +289,7 @@ class ProgressBarReporter(SimpleReporter):
         if not hasattr(self.bar, 'fp'):
             return
 
-        for pos in range(1, self.jobs+1):
+        for pos in range(1, job_count()+1):
             self.bar.moveto(pos)
             self.bar.fp.write('\r' + (' ' * self.bar.ncols)) # clear printing spaces
             self.bar.fp.write('\r')  # place cursor back at the beginning of line
@@ -300,12 +308,12 @@ class ProgressBarReporter(SimpleReporter):
         self.bar.update(x)
 
     def start(self, examples, runners, filepath, options):
-        if self.jobs == 1:
+        if job_count() == 1:
             position = None
         else:
-            # use multiprocessing.Process' id (number) as the position
-            # of its bar
-            position = int(multiprocessing.current_process().name) + 1
+            # use the number of the job (the multiprocessing.Process' id
+            # or the slot's) as the position of its bar
+            position = job_number() + 1
 
         SimpleReporter.start(self, examples, runners, filepath, options)
 
@@ -16,11 +16,12 @@ Example:
 """
 
 from __future__ import unicode_literals
-import re, pexpect, sys, time
+import re, pexpect, sys, time, os, termios, signal, argparse, select, codecs
 from byexample.common import log, constant
 from byexample.parser import ExampleParser, ExtendOptionParserMixin
 from byexample.finder import ExampleFinder
-from byexample.runner import ExampleRunner, PexepctMixin, ShebangTemplate
+from byexample.runner import ExampleRunner, PexepctMixin, ShebangTemplate, _ForkedSpawn, _PipeSpawn
+from byexample.executor import TimeoutException
 
 stability = 'stable'
 
@@ -127,6 +128,16 @@ _EXCEPTION_RE = re.compile(r"""
 # : : : : : : : : : : : : : : : : : : : : : : : : : : : : : : : : : : : : : : #
 ###############################################################################
 
+_module_name_re = re.compile(r'^[^\W\d]\w*(\.[^\W\d]\w*)*$', re.UNICODE)
+def _module_names(names):
+    names = [n.strip() for n in names.split(',') if n.strip()]
+    for name in names:
+        if not _module_name_re.match(name):
+            raise argparse.ArgumentTypeError(
+                    "Invalid module name '%s'. Use <module>[,<module>...] instead." % name)
+
+    return names
+
 def _example_options_string_regex_for(compatibility_mode):
     # anything of the form:
     if compatibility_mode:
@@ -156,6 +167,12 @@ class PythonParser(ExampleParser):
         return self._opts_re_for_comp if self.compatibility_mode \
                 else self._opts_re_for_noncomp
 
+    def warm_up(self):
+        # the regexs for the options are already compiled (see above)
+        # but they cannot be selected until we know the compatibility mode
+        self.capture_tag_regex()
+        self.get_extended_option_parser(self.options['optparser'])
+
     def extend_option_parser(self, parser):
         '''
         Add a few extra options and if self.compatibility_mode is True,
@@ -164,6 +181,11 @@ class PythonParser(ExampleParser):
         parser.add_flag("py-doctest", default=False, help="enable the compatibility with doctest.")
         parser.add_flag("py-pretty-print", default=True, help="enable the pretty print enhancement.")
         parser.add_flag("py-remove-empty-lines", default=True, help="enable the deletion of empty lines (enabled by default).")
+        parser.add_flag("py-zygote", default=False, help="fork the interpreter of each file from a template interpreter started once (see +py-preload).")
+        parser.add_argument("+py-preload", default=[], type=_module_names, metavar="<modules>",
+                help="import these modules (comma separated) when the interpreter starts; with +py-zygote, they are imported once in the template.")
+        parser.add_argument("+py-backend", default='repl', choices=['repl', 'driver'],
+                help="run the examples in the interactive interpreter (repl, the default) or send them to a driver loop through pipes (driver).")
 
         if getattr(self, 'compatibility_mode', True):
             parser.add_flag("NORMALIZE_WHITESPACE", default=False, help="[doctest] alias for +norm-ws.")
@@ -185,6 +207,11 @@ class PythonParser(ExampleParser):
         compatibility_mode = True if original_compatibility_mode == None \
                                   else original_compatibility_mode
 
+        # reuse the parsers built before for the same parent
+        cache = self._optparser_extended_by_comp_mode_cache
+        if not kw and cache is not None and cache[0] is parent_parser:
+            return cache[1][compatibility_mode]
+
         tmp = {}
 
         # fake the two compatibility mode (True and False)
@@ -203,6 +230,9 @@ class PythonParser(ExampleParser):
         else:
             self.compatibility_mode = original_compatibility_mode
 
+        if not kw:
+            self._optparser_extended_by_comp_mode_cache = (parent_parser, tmp)
+
         return tmp[compatibility_mode]
 
     def _map_doctest_opts_to_byexample_opts(self):
@@ -392,9 +422,91 @@ class PythonParser(ExampleParser):
             return '\n'.join(lines)
         return snippet
 
+class _PythonDriverSpawn(_PipeSpawn):
+    r'''
+    Talk with a Python interpreter that runs the driver loop (see
+    +py-backend=driver) instead of the interactive interpreter.
+
+    Each request is a header "<kind> <size>\n" followed by <size> bytes
+    of source code (in UTF-8) and each response is a header
+    "<status> <size>\n" followed by <size> bytes of output. There are no
+    prompts to search for.
+
+    The driver sends an empty response when it is ready.
+    '''
+    def __init__(self, *args, **kargs):
+        _PipeSpawn.__init__(self, *args, **kargs)
+        self.pending = 1        # count of responses not received yet
+        self._buf = b''
+        self._remain = None     # size of the output pending or None for a new header
+        self._status = None
+        self._decoder = codecs.getincrementaldecoder(self.encoding)()
+
+    def send_request(self, kind, source):
+        data = source.encode('utf-8')
+        self._write(('%s %i\n' % (kind, len(data))).encode('ascii') + data)
+        self.pending += 1
+
+    def receive(self, sink, timeout):
+        ''' Wait up to <timeout> seconds for the next response and append
+            its output to <sink>, decoded.
+
+            Return the status of the response or None if it timed out; in
+            that case, the rest of the response can be received later.
+            '''
+        deadline = time.time() + max(timeout, 0)
+        while True:
+            if self._remain is None:
+                header, nl, rest = self._buf.partition(b'\n')
+                if nl:
+                    self._buf = rest
+                    self._status, self._remain = self._parse_header(header)
+                    continue
+            else:
+                data, self._buf = self._buf[:self._remain], self._buf[self._remain:]
+                self._remain -= len(data)
+                if data:
+                    sink.append(self._decoder.decode(data))
+
+                if not self._remain:
+                    self._decoder.reset()
+                    self._remain = None
+                    self.pending -= 1
+                    return self._status
+
+            data = self._read(deadline)
+            if data is None:
+                return None
+
+            self._buf += data
+
+    def _parse_header(self, header):
+        try:
+            status, size = header.decode('ascii').split()
+            return status, int(size)
+        except (UnicodeDecodeError, ValueError):
+            raise ValueError("Unexpected output from the interpreter (is the driver running?): %r" % (header + self._buf)[:1000])
+
+    def _read(self, deadline):
+        if self._stash:
+            data, self._stash = self._stash, b''
+            return data
+
+        fd = self.child_fd
+        ready, _, _ = select.select([fd], [], [], max(deadline - time.time(), 0))
+        if not ready:
+            return None
+
+        data = os.read(fd, self.maxread)
+        if not data:
+            raise pexpect.EOF("The interpreter exited.")
+        return data
+
 class PythonInterpreter(ExampleRunner, PexepctMixin):
     language = 'python'
 
+    PIPE_TRANSPORT = True
+
     def __init__(self, verbosity, encoding, **unused):
         self.encoding = encoding
 
@@ -405,7 +517,11 @@ class PythonInterpreter(ExampleRunner, PexepctMixin):
                                 PS1_re = self._PS1,
                                 any_PS_re = r'/byexample/py/ps\d> ')
 
-    def get_default_cmd(self, pretty_print, columns, *args, **kargs):
+        # the template interpreter and its command (see _fork_from_zygote)
+        self._zygote = None
+        self._zygote_cmd = None
+
+    def get_default_cmd(self, pretty_print, columns, zygote=False, preload=(), driver=False, *args, **kargs):
         # Important: do not use a single quote ' in the following python code
         # it will break it in real hard ways to debug.
         change_prompts = r'''
@@ -416,6 +532,33 @@ import pprint as _byexample_pprint
 sys.ps1="%s"
 sys.ps2="%s"
 
+# execute each statement of the source like the interactive interpreter
+# does: used to send a whole example at once (see +block)
+def __byexample_exec_block(source):
+    import sys, ast
+    try:
+        module = compile(source, "<stdin>", "exec", ast.PyCF_ONLY_AST)
+    except SyntaxError:
+        # like the interactive interpreter, show it without a traceback
+        t, v = sys.exc_info()[:2]
+        v.__traceback__ = None
+        sys.excepthook(t, v, None)
+        return
+
+    for stmt in module.body:
+        ast.increment_lineno(stmt, 1 - stmt.lineno)
+        try:
+            exec(compile(ast.Interactive([stmt]), "<stdin>", "single"), globals())
+        except SystemExit:
+            raise
+        except:
+            # hide this function from the traceback (Python 3 prints
+            # the one of the exception, not the one given)
+            t, v, tb = sys.exc_info()
+            v.__traceback__ = tb.tb_next
+            sys.excepthook(t, v, tb.tb_next)
+            return
+
 if %s:
     class __ByexamplePrettyPrint(_byexample_pprint.PrettyPrinter):
         def __init__(self, *args, **kargs):
@@ -463,24 +606,272 @@ if %s:
                     None if s is None
                     else __byexample_pretty_print.pprint(s))
 
+# import the modules that the examples will use (see +py-preload)
+def __byexample_preload(names):
+    for name in names:
+        try:
+            __import__(name)
+        except ImportError:
+            pass # let the example that imports it to fail
+
+__byexample_preload([%s])
+del __byexample_preload
+
+if %s:
+    # we are a template (see +py-zygote): fork a child moved to a new
+    # session with <tty> as its terminal; the child keeps running the
+    # interactive loop there while we wait for the next fork.
+    import signal as _byexample_signal
+    _byexample_signal.signal(_byexample_signal.SIGCHLD, _byexample_signal.SIG_IGN)
+    del _byexample_signal
+
+    def __byexample_fork(tty):
+        import os, signal
+        pid = os.fork()
+        if pid:
+            return pid
+
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.setsid()
+        fd = os.open(tty, os.O_RDWR)
+        for n in (0, 1, 2):
+            os.dup2(fd, n)
+        os.close(fd)
+
+        # the child is not a template: do not leave this to the examples
+        del globals()['__byexample_fork']
+
 # remove introduced symbols
 del sys
 del _byexample_pprint
-''' % (self._PS1, self._PS2, pretty_print, columns)
+''' % (self._PS1, self._PS2, pretty_print, columns,
+        ', '.join('"%s"' % name for name in preload), zygote)
+
+        # the same restriction about the single quotes applies here
+        driver_loop = r'''
+# the driver loop (see +py-backend=driver): read the requests from
+# the stdin and write the responses to the stdout; the examples read
+# from /dev/null and write to a temporary file instead, their children too
+def __byexample_driver():
+    import os, sys, code, signal, tempfile
+
+    # the examples must not see the driver in their globals
+    del globals()["__byexample_driver"]
+
+    requests = os.fdopen(os.dup(0), "rb", 0)
+    responses = os.dup(1)
+
+    null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null, 0)
+    os.close(null)
+
+    out = tempfile.TemporaryFile()
+    os.dup2(out.fileno(), 1)
+    os.dup2(out.fileno(), 2)
+    out.close()
+
+    # like in the interactive interpreter, a ctrl-c interrupts the
+    # example but not the driver while it waits for the next request
+    running = [False]
+    def interrupt(signum, frame):
+        if running[0]:
+            raise KeyboardInterrupt()
+    signal.signal(signal.SIGINT, interrupt)
+
+    def write(data):
+        while data:
+            data = data[os.write(responses, data):]
+
+    def respond(status):
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        size = os.lseek(1, 0, os.SEEK_CUR)
+        write(("%s %i\n" % (status, size)).encode("ascii"))
+
+        os.lseek(1, 0, os.SEEK_SET)
+        while size:
+            data = os.read(1, min(size, 1 << 16))
+            size -= len(data)
+            write(data)
+
+        os.lseek(1, 0, os.SEEK_SET)
+        os.ftruncate(1, 0)
+
+    def read(size):
+        data = b""
+        while len(data) < size:
+            chunk = requests.read(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    # compile and run each line like the interactive interpreter does
+    console = code.InteractiveConsole(globals(), filename="<stdin>")
+
+    respond("ready")
+    while True:
+        header = requests.readline()
+        if not header:
+            return
+
+        kind, size = header.split()
+        source = read(int(size)).decode("utf-8")
+
+        status = "ok"
+        try:
+            running[0] = True
+            try:
+                if kind == b"block":
+                    __byexample_exec_block(source)
+                else:
+                    for line in source.split("\n"):
+                        more = console.push(line)
+                    if more:
+                        # the interactive interpreter would wait for
+                        # the rest of the statement forever
+                        console.resetbuffer()
+                        status = "more"
+            finally:
+                running[0] = False
+        except KeyboardInterrupt:
+            console.resetbuffer()
+            console.write("\nKeyboardInterrupt\n")
+            status = "interrupted"
+        except SystemExit:
+            respond("exit")
+            raise
+
+        respond(status)
+
+__byexample_driver()
+'''
+
+        if driver:
+            # not interactive: run the driver loop after the setup
+            args = ["-c", change_prompts + driver_loop]
+        else:
+            args = [
+                    "-i", # mean interactive, run -c arg and continue running
+                    "-c", change_prompts,  # run this before anything else
+                    ]
 
         return  "%e %p %a", {
                     'e': "/usr/bin/env",
                     'p': "python",
-                    'a': [
-                            "-i", # mean interactive, run -c arg and continue running
-                            "-c", change_prompts,  # run this before anything else
-                     ]}
+                    'a': args,
+                    }
 
     def run(self, example, options):
         return PexepctMixin._run(self, example, options)
 
+    @property
+    def _driven(self):
+        ''' True if the interpreter runs the driver loop (see +py-backend). '''
+        return isinstance(getattr(self, 'interpreter', None), _PythonDriverSpawn)
+
+    # the block is sent as a single line: keep it below the size of
+    # the line buffer of the terminal (4096 in Linux)
+    MAX_BLOCK_LEN = 4000
+
     def _run_impl(self, example, options):
-        return self._exec_and_wait(example.source, options)
+        if self._driven:
+            kind = 'block' if options['block'] else 'exec'
+            return self._request(kind, example.source, options)
+
+        block = self._block_of(example.source) if options['block'] else None
+        if block is None:
+            return self._exec_and_wait(example.source, options)
+
+        return self._exec_block_and_wait(block, options)
+
+    def submit(self, example, options):
+        if self._driven:
+            if self._terminal_default_geometry != options['geometry']:
+                return False
+
+            kind = 'block' if options['block'] else 'exec'
+            self.interpreter.send_request(kind, example.source)
+            self._in_flight.append((example, self._hides_prompts(kind, options)))
+            return True
+
+        block = self._block_of(example.source) if options['block'] else None
+        if block is None:
+            return self._submit(example, example.source, options)
+
+        return self._submit(example, block, options, block=True)
+
+    def _exec_and_wait(self, source, options, timeout=None):
+        if self._driven:
+            return self._request('exec', source, options, timeout)
+
+        return PexepctMixin._exec_and_wait(self, source, options, timeout)
+
+    def _collect(self, options):
+        if self._driven:
+            _, hide_prompts = self._in_flight.popleft()
+            self._receive(options, options['timeout'])
+            if hide_prompts:
+                self._remove_prompts()
+            return self._get_output(options)
+
+        return PexepctMixin._collect(self, options)
+
+    def _request(self, kind, source, options, timeout=None):
+        ''' Send the <source> to the driver loop to be run (see
+            _PythonDriverSpawn) and wait for its output. '''
+        if timeout == None:
+            timeout = options['timeout']
+
+        self.interpreter.send_request(kind, source)
+        self._receive(options, timeout)
+        if self._hides_prompts(kind, options):
+            self._remove_prompts()
+        return self._get_output(options)
+
+    def _hides_prompts(self, kind, options):
+        ''' Return True if the interactive interpreter would remove
+            from the output anything that looks like a prompt (see
+            _exec_framed and _exec_block_and_wait) so we do the same. '''
+        return options['frame'] or kind == 'block'
+
+    def _receive(self, options, timeout):
+        status = self.interpreter.receive(self.last_output, timeout)
+        if status is None:
+            msg = "Response not found: the code is taking too long to finish.\nLast 1000 bytes read:\n%s"
+            msg = msg % self.last_output.tail(1000)
+            out = self._get_output(options)
+            raise TimeoutException(msg, out)
+
+        if status == 'more':
+            # the interactive interpreter would hang waiting for more
+            # lines: fail right away instead, this is not a timeout
+            msg = "Incomplete code: the interpreter is waiting for more lines.\nLast 1000 bytes read:\n%s"
+            msg = msg % self.last_output.tail(1000)
+            self._drop_output()
+            raise Exception(msg)
+
+        return status
+
+    def _frame_code(self, nonce, options):
+        # split the nonce in two literals so the code does not have it
+        half = len(nonce) // 2
+        return 'print("%s" "%s")\n' % (nonce[:half], nonce[half:])
+
+    def _block_of(self, source):
+        ''' Return a single line that executes all the <source> at
+            once (see __byexample_exec_block) or None if the source is
+            a single line (nothing to gain) or if it is too large.
+            '''
+        if '\n' not in source.rstrip('\n'):
+            return None
+
+        # escape it to be a valid string literal in Python 2.x and 3.x
+        literal = source.encode('unicode_escape').decode('ascii').replace('"', '\\"')
+        block = '__byexample_exec_block(u"%s")\n' % literal
+
+        return block if len(block) <= self.MAX_BLOCK_LEN else None
 
     def _change_terminal_geometry(self, rows, cols, options):
         # update the pretty printer with the new columns value
@@ -489,6 +880,9 @@ del _byexample_pprint
         PexepctMixin._change_terminal_geometry(self, rows, cols, options)
 
     def interact(self, example, options):
+        if self._driven:
+            raise Exception("The interaction is not supported with +py-backend=driver.")
+
         PexepctMixin.interact(self)
 
     def initialize(self, options):
@@ -497,16 +891,148 @@ del _byexample_pprint
         pretty_print = (py_doctest and py_pretty_print) \
                         or not py_doctest
 
-        shebang, tokens = self.get_default_cmd(pretty_print, options['geometry'][1])
+        driver = options['py_backend'] == 'driver'
+
+        # the template needs a terminal to fork an interpreter in another
+        zygote = options['py_zygote'] and not self._pipe_transport(options) \
+                    and not driver
+
+        shebang, tokens = self.get_default_cmd(pretty_print, options['geometry'][1],
+                                                zygote, options['py_preload'], driver)
         shebang = options['shebangs'].get(self.language, shebang)
 
         cmd = ShebangTemplate(shebang).quote_and_substitute(tokens)
 
+        if driver:
+            return self._start_driver(cmd, options)
+
+        if zygote:
+            return self._fork_from_zygote(cmd, options)
+
+        # without a terminal, the output of Python is fully buffered
+        env = {'PYTHONUNBUFFERED': '1'} if self._pipe_transport(options) else None
+
         # run!
-        self._spawn_interpreter(cmd, options)
+        self._spawn_interpreter(cmd, options, env=env)
+
+    def _start_driver(self, cmd, options):
+        ''' Spawn the interpreter running <cmd>, the driver loop, connected
+            by pipes and wait until it is ready (see _PythonDriverSpawn). '''
+        def spawner(rows, cols, env, **kargs):
+            # like with +transport=pipe, the output must not be buffered
+            # or it would be out of order
+            env = dict(env, PYTHONUNBUFFERED='1', PYTHONIOENCODING=self.encoding)
+            return _PythonDriverSpawn(cmd, env=env, **kargs)
+
+        self._spawn_interpreter(cmd, options, wait_first_prompt=False,
+                                                spawner=spawner)
+        self._receive(options, options['x']['dfl_timeout'])
+        self._drop_output()
+
+    def _fork_from_zygote(self, cmd, options):
+        ''' Fork the interpreter from a template interpreter (the zygote)
+            that is started once, running <cmd>, and kept alive for the
+            next files.
+
+            The child is moved to a new pty that we create so it looks
+            like any other spawned interpreter, but it does not need to
+            boot nor to import the modules imported by the template
+            (see +py-preload).
+            '''
+        if self._zygote is not None and (self._zygote_cmd != cmd or \
+                not self._zygote.interpreter.isalive()):
+            self._shutdown_zygote()
+
+        if self._zygote is None:
+            zygote = PythonInterpreter(verbosity=0, encoding=self.encoding)
+            zygote._spawn_interpreter(cmd, options)
+            self._zygote, self._zygote_cmd = zygote, cmd
+
+        master, slave = os.openpty()
+        pid = None
+        try:
+            attr = termios.tcgetattr(slave)
+            attr[3] &= ~termios.ECHO
+            termios.tcsetattr(slave, termios.TCSANOW, attr)
+
+            source = '__byexample_fork("%s")' % os.ttyname(slave)
+            out = self._zygote._exec_and_wait(source, options,
+                                    timeout=options['x']['dfl_timeout'])
+            pid = int(out.strip())
+
+            def spawner(rows, cols, env, **kargs):
+                child = _ForkedSpawn(master, pid, **kargs)
+                child.setwinsize(rows, cols)
+                return child
+
+            # keep our side of the slave open until the child opened
+            # it too (we get its first prompt) or reading from the master
+            # would fail
+            self._spawn_interpreter(cmd, options, spawner=spawner)
+        except:
+            if pid is not None:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
+
+    def _shutdown_zygote(self):
+        zygote, self._zygote, self._zygote_cmd = self._zygote, None, None
+        try:
+            zygote.shutdown()
+        except Exception:
+            pass    # it is not our interpreter, do not fail because of it
 
     def shutdown(self):
         self._shutdown_interpreter()
 
+    def release(self):
+        # the template outlives the interpreters forked from it
+        # (see _fork_from_zygote)
+        if self._zygote is not None:
+            self._shutdown_zygote()
+
+    def reset(self, options):
+        # some examples were sent but never run (see submit)
+        if self._in_flight:
+            return False
+
+        # remove any name defined by the examples (but keep the names
+        # starting with __ like __builtins__ and our pretty printer)
+        # and go back to the original working directory.
+        #
+        # the modules imported are still in sys.modules: this is a feature,
+        # the next file will not need to pay the import cost again.
+        reset_code = '''for __byexample_k in [__k for __k in globals() if not __k.startswith("__")]: del globals()[__byexample_k]
+
+__import__("os").chdir(%s)
+''' % repr(os.getcwd())
+
+        out = self._exec_and_wait(reset_code, options,
+                                timeout=options['x']['dfl_timeout'])
+
+        # any output means that something went wrong
+        return not out.strip()
+
     def cancel(self, example, options):
-        return self._abort(example, options)
+        if not self._driven:
+            return self._abort(example, options)
+
+        if self._in_flight:
+            # the examples already sent will be executed anyways
+            self._in_flight.clear()
+            return False
+
+        if not self.interpreter.pending:
+            return True     # nothing is running (see _receive)
+
+        # interrupt the example and discard its output
+        self.interpreter.sendcontrol('c')
+        status = self.interpreter.receive(self.last_output,
+                                            options['x']['dfl_timeout'])
+        self._drop_output()
+        return status is not None
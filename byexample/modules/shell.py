@@ -77,6 +77,8 @@ class ShellParser(ExampleParser):
 class ShellInterpreter(ExampleRunner, PexepctMixin):
     language = 'shell'
 
+    PIPE_TRANSPORT = True
+
     def __init__(self, verbosity, encoding, **unused):
         self.encoding = encoding
 
@@ -97,8 +99,11 @@ class ShellInterpreter(ExampleRunner, PexepctMixin):
     def _run_impl(self, example, options):
         stop_on_timeout = options['stop_on_timeout'] is not False
         stop_on_silence = options['stop_on_silence'] is not False
+        block = self._block_of(example.source) if options['block'] else None
         try:
-            return self._exec_and_wait(example.source, options)
+            if block is None:
+                return self._exec_and_wait(example.source, options)
+            return self._exec_block_and_wait(block, options)
         except TimeoutException as ex:
             if stop_on_timeout or stop_on_silence:
                 # get the current output
@@ -106,8 +111,12 @@ class ShellInterpreter(ExampleRunner, PexepctMixin):
 
                 # stop the process to get back the control of the shell.
                 # this require that the job monitoring system of
-                # the shell is on (set -m)
-                self.interpreter.sendcontrol('z')
+                # the shell is on (set -m); without a terminal there is
+                # no job control so we interrupt the process instead
+                if self._transport == 'pipe':
+                    self.interpreter.sendcontrol('c')
+                else:
+                    self.interpreter.sendcontrol('z')
 
                 # wait for the prompt, ignore any extra output
                 self._expect_prompt(
@@ -119,6 +128,45 @@ class ShellInterpreter(ExampleRunner, PexepctMixin):
                 return out
             raise
 
+    def submit(self, example, options):
+        # we need to wait for each example to stop it on timeout or on
+        # silence (see _run_impl)
+        if options['stop_on_timeout'] is not False or \
+                options['stop_on_silence'] is not False:
+            return False
+
+        block = self._block_of(example.source) if options['block'] else None
+        if block is None:
+            return self._submit(example, example.source, options)
+
+        return self._submit(example, block, options, block=True)
+
+    def _frame_code(self, nonce, options):
+        # we need to wait for the prompts to stop the process
+        # on timeout or on silence (see _run_impl)
+        if options.get('stop_on_timeout', False) is not False or \
+                options.get('stop_on_silence', False) is not False:
+            return None
+
+        # split the nonce in two literals so the code does not have it
+        half = len(nonce) // 2
+        return "echo '%s''%s'\n" % (nonce[:half], nonce[half:])
+
+    _EOF = '/byexample/sh/eof'
+
+    def _block_of(self, source):
+        ''' Return a command that evaluates all the <source> at once,
+            passing it in a here-document, or None if the source is a single
+            line (nothing to gain) or if it has a line that would end the
+            here-document too early.
+            '''
+        lines = source.rstrip('\n').split('\n')
+        if len(lines) == 1 or self._EOF in lines:
+            return None
+
+        return 'eval "$(cat <<\'%s\'\n%s\n%s\n)"\n' % (self._EOF,
+                                            '\n'.join(lines), self._EOF)
+
     def _expect_prompt(self, options, timeout, prompt_re=None):
         if options['stop_on_silence'] is not False:
             silence_timeout = options['stop_on_silence']
@@ -151,6 +199,10 @@ class ShellInterpreter(ExampleRunner, PexepctMixin):
         shebang, tokens = self.get_default_cmd()
         shebang = options['shebangs'].get(self.language, shebang)
 
+        # without a terminal, the shell must be told to be interactive
+        if self._pipe_transport(options):
+            tokens['a'] = tokens['a'] + ['-i']
+
         cmd = ShebangTemplate(shebang).quote_and_substitute(tokens)
         self._spawn_interpreter(cmd, options, wait_first_prompt=False)
 
@@ -0,0 +1,217 @@
+from __future__ import unicode_literals
+import hashlib, os, errno
+
+from .history import Store
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+def _hash_sources(h, dirnames):
+    ''' Update the hash <h> with the name, size and modification time
+        of the Python files in <dirnames>: the code of byexample and
+        of its modules that finds and parses the examples. '''
+    for dirname in dirnames:
+        try:
+            names = sorted(os.listdir(dirname))
+        except OSError:
+            continue
+
+        for name in names:
+            if not name.endswith('.py'):
+                continue
+
+            filepath = os.path.join(dirname, name)
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue
+
+            h.update(('%s %i %i' % (filepath, st.st_size, st.st_mtime)).encode('utf-8'))
+
+def parse_signature(args, version):
+    ''' Return a hash of all the things, except the files themselves,
+        that may change how the examples are found and parsed: the
+        command line options, the byexample <version> and the
+        code of byexample and of its modules. '''
+    h = hashlib.sha1()
+    h.update(version.encode('utf-8'))
+
+    for name in ('languages', 'options_str', 'encoding', 'modules_dirs'):
+        h.update(repr((name, getattr(args, name, None))).encode('utf-8'))
+
+    _hash_sources(h, [os.path.dirname(os.path.abspath(__file__))] + list(args.modules_dirs))
+    return h.hexdigest()
+
+class ParseCache(object):
+    r'''
+    Remember the examples found and parsed in each file so we do not
+    find and parse them again if neither the file nor the environment
+    changed (see parse_signature).
+
+    Each example is remembered as a record: what the finder found and,
+    if the example was parsed, what the parser built from it.
+
+        >>> from byexample.parse_cache import ParseCache
+        >>> cache = ParseCache(None, 'env-A')
+
+        >>> key = cache.key_of('foo.md', None)
+        >>> content = cache.content_hash('>>> 1 + 2\n3\n')
+        >>> cache.lookup(key, content) is None
+        True
+
+    Once the examples of a file are harvested and parsed, we can
+    record them:
+
+        >>> class Example(object):
+        ...     parse_state = 'parsed'
+        >>> cache.harvested(key, content, ['found'], [Example()])
+        >>> cache.record_parsed(key)
+
+        >>> cache.lookup(key, content)
+        [('found', 'parsed')]
+
+    If the file changes, the examples need to be harvested again:
+
+        >>> cache.lookup(key, cache.content_hash('>>> 1 + 3\n4\n')) is None
+        True
+
+    The same happens if the environment changes:
+
+        >>> ParseCache(None, 'env-B').content_hash('>>> 1 + 2\n3\n') == content
+        False
+
+    The examples are saved in disk only if a directory name was given:
+    one file per key so several byexample instances can save their
+    examples without overwriting the ones saved by the others and
+    a lookup reads only the file of its key.
+
+        >>> import shutil, tempfile
+        >>> cache = ParseCache(None, 'env-A')
+        >>> cache.dirname = tempfile.mkdtemp()
+
+        >>> cache.harvested(key, content, ['found'], [Example()])
+        >>> cache.record_parsed(key)
+        >>> cache.save()
+
+        >>> other = ParseCache(None, 'env-A')
+        >>> other.dirname = cache.dirname
+        >>> other.lookup(key, content)
+        [('found', 'parsed')]
+
+        >>> shutil.rmtree(cache.dirname)
+    '''
+    def __init__(self, dirname, signature):
+        if dirname:
+            self.dirname = Store._store_filepath(dirname)
+            self._make_dir()
+        else:
+            self.dirname = None
+
+        self.signature = signature
+        self._entries = {}
+        self._recorded = {}
+        self._harvested = {}
+
+    def _make_dir(self):
+        try:
+            os.makedirs(self.dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+            if not os.path.isdir(self.dirname):
+                # the single file used by older versions of byexample
+                os.remove(self.dirname)
+                os.makedirs(self.dirname)
+
+    def _entry_filepath(self, key):
+        return os.path.join(self.dirname,
+                                hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def key_of(self, filepath, shard):
+        # the shard (if any) has the file path and the lines of the shard
+        return os.path.abspath(str(shard) if shard is not None else filepath)
+
+    def content_hash(self, string):
+        h = hashlib.sha1(self.signature.encode('utf-8'))
+        h.update(string.encode('utf-8'))
+        return h.hexdigest()
+
+    def lookup(self, key, content):
+        ''' Return the records of the examples of <key> if its
+            <content> did not change, None otherwise. '''
+        try:
+            cached_content, records = self._entries[key]
+        except KeyError:
+            entry = self._load_entry(key)
+            if entry is None:
+                return None
+            cached_content, records = self._entries[key] = entry
+
+        return records if cached_content == content else None
+
+    def _load_entry(self, key):
+        if self.dirname is None:
+            return None
+
+        try:
+            with open(self._entry_filepath(key), 'rb') as f:
+                cached_key, content, records = pickle.loads(f.read())
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        except Exception:
+            # possible corrupt file, ignore it
+            return None
+
+        return (content, records) if cached_key == key else None
+
+    def harvested(self, key, content, records, examples):
+        ''' Remember the <records> of the <examples> just found.
+
+            They are recorded once the examples are parsed
+            (see record_parsed).
+            '''
+        self._harvested[key] = (content, records, examples)
+
+    def record_parsed(self, key):
+        ''' Record the examples of <key> with the state of the ones that
+            were parsed (see ExampleParser.parse). '''
+        try:
+            content, records, examples = self._harvested.pop(key)
+        except KeyError:
+            return
+
+        records = [(record, getattr(example, 'parse_state', None))
+                        for record, example in zip(records, examples)]
+
+        # do not let an example that we cannot save break the whole cache
+        try:
+            pickle.dumps(records, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return
+
+        self._entries[key] = self._recorded[key] = (content, records)
+
+    def save(self):
+        ''' Save the recorded examples, each key in its own file.
+
+            Each file is replaced atomically so the readers see the
+            old or the new examples but never a mix of them.
+            '''
+        if self.dirname is None:
+            self._recorded = {}
+            return
+
+        for key, (content, records) in self._recorded.items():
+            filepath = self._entry_filepath(key)
+            tmp = '%s.tmp-%i' % (filepath, os.getpid())
+            with open(tmp, 'wb') as f:
+                pickle.dump((key, content, records), f, pickle.HIGHEST_PROTOCOL)
+
+            os.rename(tmp, filepath)
+
+        self._recorded = {}
@@ -1,7 +1,7 @@
 from __future__ import unicode_literals
 import re, shlex, argparse
 from .common import log, tohuman, constant
-from .options import OptionParser, UnrecognizedOption, ExtendOptionParserMixin
+from .options import Options, OptionParser, UnrecognizedOption, ExtendOptionParserMixin
 from .expected import _LinearExpected, _RegexExpected
 from .parser_sm import SM_NormWS, SM_NotNormWS
 
@@ -55,6 +55,34 @@ class ExampleParser(ExtendOptionParserMixin):
         '''
         return parser
 
+    def get_extended_option_parser(self, parent_parser, **kw):
+        '''
+        See options.ExtendOptionParserMixin.
+
+        Building a parser is expensive so the parser is cached and
+        reused while the <parent_parser> is the same.
+        '''
+        if kw:
+            return ExtendOptionParserMixin.get_extended_option_parser(
+                                                self, parent_parser, **kw)
+
+        cache = self._optparser_extended_cache
+        if cache is None or cache[0] is not parent_parser:
+            cache = (parent_parser, ExtendOptionParserMixin.get_extended_option_parser(
+                                                self, parent_parser))
+            self._optparser_extended_cache = cache
+
+        return cache[1]
+
+    def warm_up(self):
+        '''
+        Compile the regexs and build the option parsers so they are
+        ready before spawning the workers (which will inherit them).
+        '''
+        self.example_options_string_regex()
+        self.capture_tag_regex()
+        self.get_extended_option_parser(self.options['optparser'])
+
     @constant
     def capture_tag_regex(self):
         '''
@@ -96,12 +124,24 @@ class ExampleParser(ExtendOptionParserMixin):
     def parse(self, example, concerns):
         options = self.options
 
-        local_options = self.extract_options(example.snippet)
+        # the example may come from the parse cache with the results
+        # of parsing it in a previous run (see ParseCache)
+        cached = getattr(example, 'cached_parse', None)
+
+        if cached is None:
+            local_options = self.extract_options(example.snippet)
+        else:
+            local_options = Options(cached[0])
         options.up(local_options)
 
-        example.source, example.expected_str = self.process_snippet_and_expected(
+        if cached is None:
+            example.source, example.expected_str = self.process_snippet_and_expected(
                                                               example.snippet,
                                                               example.expected_str)
+        else:
+            example.source, example.expected_str = cached[1], cached[2]
+
+        source, expected_str = example.source, example.expected_str
 
         # the options to customize this example
         example.options = local_options
@@ -112,11 +152,20 @@ class ExampleParser(ExtendOptionParserMixin):
         for x in options['rm']:
             example.expected_str = example.expected_str.replace(x, '')
 
-        expected_regexs, charnos, rcounts, tags_by_idx = self.expected_as_regexs(
+        # the regexs depend only on the expected string (the options are
+        # the same): reuse them unless a concern changed the string
+        if cached is not None and cached[3][0] == example.expected_str:
+            expected_regexs, charnos, rcounts, tags_by_idx = cached[3][1:]
+        else:
+            expected_regexs, charnos, rcounts, tags_by_idx = self.expected_as_regexs(
                                                 example.expected_str,
                                                 options['tags'],
                                                 options['norm_ws'])
 
+        example.parse_state = (dict(local_options), source, expected_str,
+                                (example.expected_str, expected_regexs, charnos,
+                                    rcounts, tags_by_idx))
+
         ExpectedClass = _LinearExpected
 
         expected = ExpectedClass(
@@ -1,10 +1,14 @@
 from __future__ import unicode_literals
-import re, pexpect, time, termios, operator, string, shlex, os, itertools, contextlib
+import re, pexpect, time, termios, operator, string, shlex, os, itertools, contextlib, collections, uuid, subprocess, signal, fcntl, struct, select, errno
+from pexpect.fdpexpect import fdspawn
 from functools import reduce, partial
 from .executor import TimeoutException
+from .sink import OutputSink
 from .common import tohuman
 
 from pyte import Stream, Screen
+from pyte.screens import Margins
+from wcwidth import wcwidth
 
 try:
     from shlex import quote as shlex_quote
@@ -132,6 +136,37 @@ class ExampleRunner(object):
         '''
         raise NotImplementedError() # pragma: no cover
 
+    def reset(self, options):
+        '''
+        Hook to reset the runner after running all the examples of a file
+        so it can be reused to run the examples of another file without
+        shutting it down and initializing it again.
+
+        Return True if the reset succeeded and the runner can be reused,
+        False otherwise (the runner will be shutdown and initialized again).
+        '''
+        return False
+
+    def release(self):
+        '''
+        Hook to release what the runner keeps between files even after
+        its shutdown, like a template interpreter. This method will be
+        called once there is no more files to process.
+        '''
+        pass
+
+    def submit(self, example, options):
+        '''
+        Hook to pipeline the examples: send the example to the interpreter
+        without waiting for its output. The output will be collected when
+        the example is run (see run).
+
+        Return True if the example was sent, False if the runner does not
+        support this or cannot do it for this example (it will be run
+        as usual).
+        '''
+        return False
+
     def cancel(self, example, options):
         '''
         Abort the execution of the current example. This method will typically
@@ -143,30 +178,562 @@ class ExampleRunner(object):
         return False
 
 
+class _GrowMaxread(object):
+    ''' Double the size of the reads of the <spawn>, up to <limit>, each
+        time that a read fills it completely: there is more output waiting.
+
+        pexpect calls write with each chunk read (see spawn.logfile_read).
+        '''
+    def __init__(self, spawn, limit):
+        self.spawn = spawn
+        self.limit = limit
+
+    def write(self, data):
+        if len(data) >= self.spawn.maxread:
+            self.spawn.maxread = min(self.spawn.maxread * 2, self.limit)
+
+    def flush(self):
+        pass
+
+def _wait_exit(spawn, timeout):
+    ''' Wait up to <timeout> seconds for the process of <spawn> to exit;
+        return False if it is still alive. '''
+    end = time.time() + timeout
+    while spawn.isalive():
+        if time.time() > end:
+            return False
+        time.sleep(0.001)
+    return True
+
+class _PipeSpawn(fdspawn):
+    r''' Spawn <cmd> connected by a pair of pipes instead of by a pty
+        (see +transport=pipe): the output (stdout and stderr) is read
+        from one pipe with select and nonblocking reads, the input is
+        written to the other.
+
+        The child runs in its own session so a ctrl-c can be sent to it
+        and to its children as a SIGINT (there is no terminal to do it).
+
+        The input is written without blocking (see _write) so we can send
+        more data than what the pipes can hold even if the child writes
+        back as much as it reads:
+
+            >>> from byexample.runner import _PipeSpawn
+            >>> cat = _PipeSpawn('cat', None, encoding='utf-8')
+
+            >>> cat.send('x' * (1 << 20))
+            1048576
+
+            >>> out = ''
+            >>> while len(out) < (1 << 20):
+            ...     out += cat.read_nonblocking(1 << 16, timeout=5)
+            >>> out == 'x' * (1 << 20)
+            True
+
+            >>> cat.sendeof(); cat.terminate()
+        '''
+    def __init__(self, cmd, env, **kargs):
+        self.proc = subprocess.Popen(shlex.split(cmd),
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        bufsize=0,
+                                        close_fds=True,
+                                        preexec_fn=os.setsid,
+                                        env=env)
+        fdspawn.__init__(self, self.proc.stdout, **kargs)
+        self.pid = self.proc.pid
+
+        fd = self.proc.stdin.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        # output read while we were writing (see _write)
+        self._stash = b''
+
+    def send(self, s):
+        s = self._coerce_send_string(s)
+        self._log(s, 'send')
+
+        b = self._encoder.encode(s, final=False)
+        self._write(b)
+        return len(b)
+
+    def _write(self, data):
+        ''' Write all the <data> to the input of the child.
+
+            If the pipe is full, read the output of the child meanwhile
+            and keep it for later (see read_nonblocking): a child blocked
+            writing its output will not read its input and we would
+            block each other forever.
+            '''
+        fd = self.proc.stdin.fileno()
+        reading = True
+        while data:
+            try:
+                data = data[os.write(fd, data):]
+                continue
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+            rlist = [self.child_fd] if reading else []
+            readable, _, _ = select.select(rlist, [fd], [])
+            if readable:
+                chunk = os.read(self.child_fd, self.maxread)
+                if chunk:
+                    self._stash += chunk
+                else:
+                    reading = False     # EOF, read it again later
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        if not self._stash:
+            return fdspawn.read_nonblocking(self, size, timeout)
+
+        s, self._stash = self._stash[:size], self._stash[size:]
+        s = self._decoder.decode(s, final=False)
+        self._log(s, 'read')
+        return s
+
+    def sendeof(self):
+        self.proc.stdin.close()
+
+    def sendcontrol(self, char):
+        if char != 'c':
+            raise NotImplementedError("ctrl-%s cannot be sent without a terminal." % char)
+        self._killpg(signal.SIGINT)
+
+    def setwinsize(self, rows, cols):
+        pass    # there is no terminal
+
+    def isalive(self):
+        return self.proc.poll() is None
+
+    def close(self):
+        for pipe in (self.proc.stdin, self.proc.stdout):
+            if not pipe.closed:
+                pipe.close()
+
+        self.child_fd = -1
+        self.closed = True
+
+    def terminate(self, force=False):
+        # like closing a pty: hang up the child and its children
+        self._killpg(signal.SIGHUP)
+        if force and not _wait_exit(self, timeout=0.1):
+            self._killpg(signal.SIGKILL)
+
+        self.proc.wait()
+
+    def _killpg(self, sig):
+        try:
+            os.killpg(self.pid, sig)
+        except OSError:
+            pass    # all the processes are gone
+
+class _ForkedSpawn(fdspawn):
+    ''' Talk with a process that we did not spawn (see +py-zygote)
+        through the master side of its pty (<fd>).
+
+        The process <pid> is not our child: we can signal it but we
+        cannot wait for it.
+        '''
+    def __init__(self, fd, pid, **kargs):
+        fdspawn.__init__(self, fd, **kargs)
+        self.pid = pid
+
+    def sendcontrol(self, char):
+        # like pexpect.spawn.sendcontrol: ctrl-<char> is <char> & 0x1f
+        return self.send(chr(ord(char.lower()) & 0x1f))
+
+    def sendeof(self):
+        eof = termios.tcgetattr(self.child_fd)[6][termios.VEOF]
+        if isinstance(eof, bytes):
+            eof = eof.decode('ascii')
+        return self.send(eof)
+
+    def setwinsize(self, rows, cols):
+        fcntl.ioctl(self.child_fd, termios.TIOCSWINSZ,
+                        struct.pack(str('HHHH'), rows, cols, 0, 0))
+
+    def isalive(self):
+        try:
+            os.kill(self.pid, 0)
+            return True
+        except OSError:
+            return False
+
+    def close(self):
+        if self.child_fd != -1:
+            os.close(self.child_fd)
+
+        self.child_fd = -1
+        self.closed = True
+
+    def terminate(self, force=False):
+        self._kill(signal.SIGHUP)
+        if force and not _wait_exit(self, timeout=0.1):
+            self._kill(signal.SIGKILL)
+
+    def _kill(self, sig):
+        try:
+            os.kill(self.pid, sig)
+        except OSError:
+            pass    # already gone
+
+class _LineNormalizer(object):
+    r'''
+    Normalize the new lines of a stream of pieces of output in a single
+    pass: any line break (like \r\n or \r, see str.splitlines) becomes
+    a \n and the last one is dropped.
+
+    Optionally, expand the tabs (each 8 columns) and remove the trailing
+    whitespace of each line.
+
+    The pieces can be split anywhere, even in the middle of a \r\n
+    or of a line:
+
+        >>> from byexample.runner import _LineNormalizer
+        >>> n = _LineNormalizer(expand_tabs=True, rstrip=True)
+        >>> for piece in ['a\tb  \r', '\nc', 'd\t', '\te  ', ' \r\n\r\n']:
+        ...     n.feed(piece)
+
+        >>> n.close()
+        'a       b\ncd              e\n'
+
+    Without expanding tabs nor stripping (as-is):
+
+        >>> n = _LineNormalizer(expand_tabs=False, rstrip=False)
+        >>> for piece in ['a\tb  \r', '\nc', 'd\t']:
+        ...     n.feed(piece)
+
+        >>> n.close()
+        'a\tb  \ncd\t'
+    '''
+    _line_breaks = frozenset('\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029')
+
+    def __init__(self, expand_tabs, rstrip):
+        self.expand_tabs = expand_tabs
+        self.rstrip = rstrip
+
+        self._out = []          # the normalized text, each line ended by a \n
+        self._partial = ''      # the last line, not terminated yet
+        self._after_cr = False  # the last piece ended in a \r
+
+    def feed(self, piece):
+        if not piece:
+            return
+
+        # the \n of a \r\n split between two pieces: the \r was
+        # already taken as the line break
+        if self._after_cr and piece[0] == '\n':
+            piece = piece[1:]
+            if not piece:
+                self._after_cr = False
+                return
+
+        self._after_cr = piece[-1] == '\r'
+        lines = piece.splitlines()
+
+        # the last line continues in the next piece
+        if piece[-1] not in self._line_breaks:
+            partial = lines.pop()
+        else:
+            partial = ''
+
+        if lines:
+            lines[0] = self._partial + lines[0]
+            self._out.append(self._clean(lines))
+            self._out.append('\n')
+            self._partial = partial
+        else:
+            self._partial += partial
+
+    def _clean(self, lines):
+        # work on all the lines at once: the \n resets the column
+        # of expandtabs
+        text = '\n'.join(lines)
+        if self.expand_tabs and '\t' in text:
+            text = text.expandtabs(8)
+        if self.rstrip:
+            text = '\n'.join([l.rstrip() for l in text.split('\n')])
+        return text
+
+    def close(self):
+        ''' Return the normalized output. '''
+        out = self._out
+        if self._partial:
+            out.append(self._clean([self._partial]))
+        elif out:
+            out.pop()   # the last line break is dropped
+
+        self._out, self._partial, self._after_cr = [], '', False
+        return ''.join(out)
+
+class _ScrollbackScreen(Screen):
+    ''' A pyte Screen that keeps, rendered, up to <history> lines
+        scrolled off from the top of the screen. '''
+    def __init__(self, columns, lines, history):
+        self.scrollback = collections.deque(maxlen=history)
+        Screen.__init__(self, columns, lines)
+
+    def index(self):
+        top, bottom = self.margins or Margins(0, self.lines - 1)
+
+        # ignore the scroll of a region (like the ones done by ncurses)
+        if top == 0 and self.cursor.y == bottom:
+            self.scrollback.append(self._render(self.buffer[top]))
+
+        Screen.index(self)
+
+    def _render(self, line):
+        chars = [line[x].data for x in range(self.columns)]
+        if '' not in chars:
+            return ''.join(chars).rstrip()
+
+        # like Screen.display does, skipping the stub after a wide char
+        rendered = []
+        is_wide_char = False
+        for char in chars:
+            if is_wide_char:
+                is_wide_char = False
+                continue
+            is_wide_char = wcwidth(char[0]) == 2
+            rendered.append(char)
+
+        return ''.join(rendered).rstrip()
+
+    def reset(self):
+        Screen.reset(self)
+        self.scrollback.clear()
+
+class _AnsiTerminal(object):
+    r'''
+    Emulate an ANSI terminal of <rows> x <cols> that does not lose the
+    lines scrolled off from the top: up to <history> of them are kept.
+
+        >>> from byexample.runner import _AnsiTerminal
+        >>> term = _AnsiTerminal(rows=3, cols=4, history=2)
+
+    The output that has only printable ASCII, \r\n and colors is handled
+    without going through pyte:
+
+        >>> term.feed('abcdef\r\n\x1b[31mred\x1b[0m\r\n')
+        >>> term.display()
+        ['abcd', 'ef', 'red', '']
+
+    Any other escape or control sequence is emulated by pyte:
+
+        >>> term.feed('abcdef\r\nghij\rG\x1b[31mred\x1b[0m\r\n')
+        >>> term.display()
+        ['abcd', 'ef', 'Gred', '']
+
+    In both cases, only the last <history> lines plus the ones
+    of the screen are kept:
+
+        >>> term.feed('1\r\n2\r\n3\r\n4\r\n5\r\n6')
+        >>> term.display()
+        ['2', '3', '4', '5', '6']
+
+        >>> term.feed('1\r\n2\r\n3\r\n4\r\n5\x1b[K\r\n6')
+        >>> term.display()
+        ['2', '3', '4', '5', '6']
+    '''
+    _sgr_re = re.compile(r'\x1b\[[0-9;]*m')
+    _not_plain_re = re.compile(r'[^\x20-\x7e\r\n]|\r(?!\n)|(?<!\r)\n')
+    _incomplete_re = re.compile(r'(?:\r|\x1b(?:\[[0-9;]*)?)\Z')
+
+    def __init__(self, rows, cols, history):
+        self.history = history
+        self._screen = _ScrollbackScreen(cols, rows, history)
+        self._stream = Stream(self._screen)
+
+        self._reset_plain()
+
+    def _reset_plain(self):
+        # while the output is plain we keep the rows completed and the
+        # row where the cursor is (which may be full and waiting
+        # for the next char to wrap)
+        self._plain = True
+        self._rows = collections.deque(maxlen=self.history + self._screen.lines - 1)
+        self._cur = ''
+        self._pending = ''
+
+    def feed(self, piece):
+        if self._plain:
+            piece = self._pending + piece
+            self._pending = ''
+
+            # a \r\n or an escape sequence may continue in the next piece
+            m = self._incomplete_re.search(piece)
+            text = piece[:m.start()] if m else piece
+
+            if '\x1b' in text:
+                text = self._sgr_re.sub('', text)
+
+            if not self._not_plain_re.search(text):
+                self._pending = m.group() if m else ''
+                self._feed_plain(text)
+                return
+
+            self._leave_plain()
+
+        self._stream.feed(piece)
+
+    def _feed_plain(self, text):
+        cols = self._screen.columns
+        rows = self._rows
+
+        first = True
+        for line in text.split('\r\n'):
+            if first:
+                line = self._cur + line
+                first = False
+            else:
+                rows.append(self._cur)
+
+            if len(line) > cols:
+                n = (len(line) - 1) // cols
+                rows.extend(line[i:i+cols] for i in range(0, n * cols, cols))
+                line = line[n * cols:]
+
+            self._cur = line
+
+    def _leave_plain(self):
+        ''' Load the plain output into pyte, from now on all the output
+            will be emulated by it. '''
+        rows, cur, pending = list(self._rows), self._cur, self._pending
+        self._plain = False
+
+        # the last rows are written in the screen, the rest goes
+        # directly to the scrollback
+        split = max(len(rows) - (self._screen.lines - 1), 0)
+        self._screen.scrollback.extend(row.rstrip() for row in rows[:split])
+        self._stream.feed(''.join(row + '\r\n' for row in rows[split:]) + cur + pending)
+
+    def resize(self, rows, cols):
+        if self._plain and (self._rows or self._cur or self._pending):
+            self._leave_plain()
+
+        self._screen.resize(rows, cols)
+        if self._plain:
+            self._reset_plain()
+
+    def display(self):
+        ''' Return the lines scrolled off plus the ones in the screen,
+            without their trailing whitespace, and reset the terminal. '''
+        if self._plain and self._pending:
+            self._leave_plain()
+
+        if self._plain:
+            lines = [row.rstrip() for row in self._rows]
+            lines.append(self._cur.rstrip())
+
+            nmissing = self._screen.lines - len(lines)
+            if nmissing > 0:
+                lines.extend([''] * nmissing)
+        else:
+            lines = list(self._screen.scrollback)
+            lines.extend(line.rstrip() for line in self._screen.display)
+
+        self._screen.reset()
+        self._reset_plain()
+        return lines
+
 class PexepctMixin(object):
+    # search the prompts only in the last characters read: the interpreter
+    # prints the prompt at the end, when it waits for more input, so we
+    # do not need to scan again and again all the output of the example
+    PROMPT_SEARCH_WINDOW = 4096
+
+    # read in chunks of MIN_MAXREAD characters, growing up to
+    # MAX_MAXREAD while the examples print a lot (see _GrowMaxread
+    # and _shrink_maxread)
+    MIN_MAXREAD = 2000
+    MAX_MAXREAD = 1 << 20
+
+    # with +term=ansi, keep up to TERMINAL_HISTORY lines scrolled off
+    # from the top of the terminal (see _AnsiTerminal)
+    TERMINAL_HISTORY = 10000
+
+    # set to True if the interpreter works connected by pipes instead
+    # of by a terminal (see +transport and _PipeSpawn)
+    PIPE_TRANSPORT = False
+
+    # send ahead up to PIPELINE_MAX_BYTES bytes of source: well under the
+    # input buffer of a pty (4 KiB in Linux) so we never block writing
+    # while the interpreter is blocked writing an output that we are not
+    # reading yet (see _submit)
+    PIPELINE_MAX_BYTES = 2048
+
     def __init__(self, PS1_re, any_PS_re):
         self.PS1_re = re.compile(PS1_re)
         self.any_PS_re = re.compile(any_PS_re)
 
-        self.last_output = []
+        # spill the output to disk once it is larger than this
+        # (see OutputSink); 0 means never
+        self._spill_threshold = 0
+        self.last_output = OutputSink(self._spill_threshold)
+
+        # examples sent but whose output was not collected yet (see _submit)
+        self._in_flight = collections.deque()
+
+        # the nonce that the interpreter has still to print (see _exec_framed)
+        self._pending_nonce = None
+
+        self._transport = 'pty'
+
+    def _pipe_transport(self, options):
+        ''' Return True if the interpreter will be (or is) connected by
+            pipes: the user asked for it and the runner supports it. '''
+        return self.PIPE_TRANSPORT and options['transport'] == 'pipe'
 
     def _spawn_interpreter(self, cmd, options, wait_first_prompt=True,
-                                        first_prompt_timeout=None):
+                                        first_prompt_timeout=None, env=None,
+                                        spawner=None):
+        ''' Spawn the interpreter running <cmd> connected by a pty
+            or by pipes (see +transport).
+
+            If given, call <spawner> instead with the geometry (rows
+            and columns), the environment and the keyword arguments for
+            pexpect; it must return an object like pexpect.spawn, connected
+            by pipes if it is a _PipeSpawn or by a pty otherwise.
+            '''
         if first_prompt_timeout is None:
             first_prompt_timeout = options['x']['dfl_timeout']
 
         rows, cols = options['geometry']
         self._terminal_default_geometry = (rows, cols)
 
-        env = os.environ.copy()
+        self._spill_threshold = options['x']['spill_output'] * 1024 * 1024
+
+        env = dict(os.environ, **(env or {}))
         env.update({'LINES': str(rows), 'COLUMNS': str(cols)})
 
         self._drop_output() # there shouldn't be any output yet but...
-        self.interpreter = pexpect.spawn(cmd, echo=False,
+        self._in_flight.clear()
+        self._pending_nonce = None
+        if spawner is not None:
+            self.interpreter = spawner(rows, cols, env=env,
+                                                encoding=self.encoding,
+                                                maxread=self.MIN_MAXREAD,
+                                                searchwindowsize=self.PROMPT_SEARCH_WINDOW)
+        elif self._pipe_transport(options):
+            self.interpreter = _PipeSpawn(cmd, env=env,
+                                                encoding=self.encoding,
+                                                maxread=self.MIN_MAXREAD,
+                                                searchwindowsize=self.PROMPT_SEARCH_WINDOW)
+        else:
+            self.interpreter = pexpect.spawn(cmd, echo=False,
                                                 encoding=self.encoding,
                                                 dimensions=(rows, cols),
-                                                env=env)
+                                                env=env,
+                                                maxread=self.MIN_MAXREAD,
+                                                searchwindowsize=self.PROMPT_SEARCH_WINDOW)
+
+        self._transport = 'pipe' if isinstance(self.interpreter, _PipeSpawn) else 'pty'
         self.interpreter.delaybeforesend = options['x']['delaybeforesend']
+        self.interpreter.logfile_read = _GrowMaxread(self.interpreter,
+                                                     self.MAX_MAXREAD)
         self.interpreter.delayafterread = None
 
         self._create_terminal(options)
@@ -184,6 +751,12 @@ class PexepctMixin(object):
                 return input_filter(input_str)
             return input_str
 
+        if self._transport == 'pipe':
+            raise Exception("The interaction with the interpreter needs a terminal: use +transport=pty.")
+
+        if not isinstance(self.interpreter, pexpect.spawn):
+            raise Exception("The interaction is not supported with an interpreter forked from a template (see +py-zygote).")
+
         attr = termios.tcgetattr(self.interpreter.child_fd)
         try:
             if send:
@@ -195,6 +768,9 @@ class PexepctMixin(object):
             termios.tcsetattr(self.interpreter.child_fd, termios.TCSANOW, attr)
 
     def _run(self, example, options):
+        if self._in_flight and self._in_flight[0][0] is example:
+            return self._collect(options)
+
         with self._change_terminal_geometry_ctx(options):
             return self._run_impl(example, options)
 
@@ -202,7 +778,8 @@ class PexepctMixin(object):
         raise NotImplementedError() # pragma: no cover
 
     def _drop_output(self):
-        self.last_output = []
+        self.last_output.close()
+        self.last_output = OutputSink(self._spill_threshold)
 
     def _shutdown_interpreter(self):
         self.interpreter.sendeof()
@@ -214,6 +791,11 @@ class PexepctMixin(object):
         if timeout == None:
             timeout = options['timeout']
 
+        if options['frame']:
+            out = self._exec_framed(source + '\n', options, timeout)
+            if out is not None:
+                return out
+
         lines = source.split('\n')
         for line in lines[:-1]:
             self.interpreter.sendline(line)
@@ -227,11 +809,226 @@ class PexepctMixin(object):
 
         return self._get_output(options)
 
+    def _exec_block_and_wait(self, block, options, timeout=None):
+        ''' Send the whole <block> in a single write and wait only for
+            the final primary prompt (PS1) instead of sending the source
+            line by line and waiting for a prompt after each one
+            (see _exec_and_wait).
+
+            The <block> must be executed by the interpreter as a single
+            unit (like a call to a function that executes the real source)
+            so it prints a single PS1 at the end.
+
+            Any other prompt printed meanwhile (like the continuation prompts
+            printed while the interpreter reads a multi-line block) is
+            removed from the output.
+            '''
+        if timeout == None:
+            timeout = options['timeout']
+
+        if options['frame']:
+            out = self._exec_framed(block, options, timeout)
+            if out is not None:
+                return out
+
+        self.interpreter.send(block)
+        self._expect_prompt(options, timeout, prompt_re=self.PS1_re)
+
+        self._remove_prompts()
+        return self._get_output(options)
+
+    def _frame_code(self, nonce, options):
+        ''' Return the code that makes the interpreter print the <nonce>
+            followed by a new line or None if the runner does not support
+            framing (the default; see _exec_framed).
+
+            The code must not have the <nonce> verbatim: the interpreter
+            may echo it.
+            '''
+        return None
+
+    def _exec_framed(self, data, options, timeout):
+        ''' Send the <data> followed by the code that prints a random
+            nonce (see _frame_code) and wait for that nonce instead of
+            for the prompts: looking for a fixed string is cheaper than
+            matching the prompt regexs on each read and an output that
+            looks like a prompt cannot make us think that the example
+            finished.
+
+            Any prompt printed meanwhile is removed from the output
+            (see _remove_prompts).
+
+            Return None if the runner does not support framing
+            or not for these <options>.
+            '''
+        code = self._new_frame(options)
+        if code is None:
+            return None
+
+        self.interpreter.send(data + code)
+        return self._collect_framed(options, timeout)
+
+    def _collect_framed(self, options, timeout):
+        self._expect_nonce(options, timeout)
+
+        self._remove_prompts()
+        return self._get_output(options)
+
+    def _remove_prompts(self):
+        ''' Join the output collected and remove any prompt from it.
+
+            The prompts are printed by the interpreter between the outputs
+            of the statements so we cannot tell them apart from an output
+            that looks like a prompt: both are removed. '''
+        output = self.last_output.sub(self.any_PS_re, '')
+        self.last_output.close()
+        self.last_output = output
+
+    def _new_frame(self, options):
+        ''' Return the code to print a new random nonce and leave it
+            pending (or None, see _frame_code). '''
+        nonce = '/byexample/%s/' % uuid.uuid4().hex
+        code = self._frame_code(nonce, options)
+        if code is not None:
+            self._pending_nonce = nonce
+
+        return code
+
+    def _expect_nonce(self, options, timeout):
+        ''' Wait for the pending nonce (see _exec_framed) and for the
+            PS1 prompt that follows it; raise a timeout if we cannot
+            find the nonce.
+
+            pexpect searches a fixed string only in the new data
+            read (plus the length of the string) so each read costs
+            a bounded suffix search.
+
+            Collect the output before the nonce into self.last_output.
+            '''
+        timeout = max(timeout, 0)
+
+        expect = [self._pending_nonce, pexpect.TIMEOUT]
+        Nonce_found, Timeout = range(len(expect))
+
+        what = self.interpreter.expect_exact(expect, timeout=timeout)
+        self._consume_before()
+
+        if what == Timeout:
+            msg = "Nonce not found: the code is taking too long to finish or there is a syntax error.\nLast 1000 bytes read:\n%s"
+            msg = msg % self.last_output.tail(1000)
+            out = self._get_output(options)
+            raise TimeoutException(msg, out)
+
+        self._pending_nonce = None
+
+        # the PS1 prompt is printed right after the nonce
+        output = self.last_output
+        self.last_output = OutputSink(self._spill_threshold)
+        self._expect_prompt(options, options['x']['dfl_timeout'],
+                                prompt_re=self.PS1_re)
+        self._drop_output()
+        self.last_output = output
+
+    def _submit(self, example, source, options, block=False):
+        ''' Send the <source> of the <example> (or a <block>, see
+            _exec_block_and_wait) without waiting for its output; the
+            output is collected later when the example is run (see _run).
+
+            The examples that change the geometry of the terminal are not
+            sent and, through a pty, neither the ones that would exceed
+            PIPELINE_MAX_BYTES of source in flight: the outputs of the
+            examples already sent must be collected first.
+
+            Return True if the example was sent, False otherwise.
+            '''
+        if self._terminal_default_geometry != options['geometry']:
+            return False
+
+        if block:
+            data = source
+            nprompts = 1
+        else:
+            data = source + '\n'
+            nprompts = len(source.split('\n'))
+
+        # the pipes do not block (see _PipeSpawn.send)
+        if self._in_flight and self._transport == 'pty':
+            in_flight = sum(entry[-1] for entry in self._in_flight)
+            if in_flight + len(data.encode(self.encoding)) > self.PIPELINE_MAX_BYTES:
+                return False
+
+        # frame the example if possible (see _exec_framed)
+        nonce = None
+        if options['frame']:
+            code = self._new_frame(options)
+            if code is not None:
+                data += code
+                nonce, self._pending_nonce = self._pending_nonce, None
+
+        self.interpreter.send(data)
+        self._in_flight.append((example, nprompts, block, nonce,
+                                len(data.encode(self.encoding))))
+        return True
+
+    def _collect(self, options):
+        ''' Wait for and return the output of the oldest example sent
+            with _submit: a prompt per line sent, being the last one
+            the PS1 (like _exec_and_wait and _exec_block_and_wait do),
+            or its nonce if it was framed (like _exec_framed does).
+            '''
+        _, nprompts, block, nonce, _ = self._in_flight.popleft()
+
+        # the interpreter may had printed the output of the following
+        # examples too so the prompt (or the nonce) that we want may not
+        # be at the end
+        with self._unbounded_prompt_search():
+            if nonce is not None:
+                self._pending_nonce = nonce
+                return self._collect_framed(options, options['timeout'])
+
+            timeout = options['timeout']
+            for _ in range(nprompts - 1):
+                begin = time.time()
+                self._expect_prompt(options, timeout)
+                timeout -= max(time.time() - begin, 0)
+
+            self._expect_prompt(options, timeout, prompt_re=self.PS1_re)
+
+        if block:
+            self._remove_prompts()
+        return self._get_output(options)
+
+    @contextlib.contextmanager
+    def _unbounded_prompt_search(self):
+        ''' Search the prompts (and nonces) in all the output read and
+            not only in its last characters (see PROMPT_SEARCH_WINDOW). '''
+        self.interpreter.searchwindowsize = None
+        try:
+            yield
+        finally:
+            self.interpreter.searchwindowsize = self.PROMPT_SEARCH_WINDOW
+
+    def _consume_before(self):
+        ''' Move the output read by the last expect to self.last_output. '''
+        before = self.interpreter.before
+        self._shrink_maxread(len(before))
+        self.last_output.append(before)
+
+        if self.last_output.spilled:
+            # do not keep alive another copy of a large output
+            self.interpreter.before = None
+
+    def _shrink_maxread(self, nread):
+        ''' Go back to smaller reads if the last expect read
+            only a few characters (<nread>). '''
+        maxread = self.interpreter.maxread
+        if nread < maxread // 4:
+            self.interpreter.maxread = max(maxread // 2, self.MIN_MAXREAD)
+
     def _create_terminal(self, options):
         rows, cols = options['geometry']
 
-        self._screen = Screen(cols, rows)
-        self._stream = Stream(self._screen)
+        self._terminal = _AnsiTerminal(rows, cols, self.TERMINAL_HISTORY)
 
     @contextlib.contextmanager
     def _change_terminal_geometry_ctx(self, options, force=False):
@@ -265,41 +1062,48 @@ class PexepctMixin(object):
             By default just send a SIGWINCH signal but you may want to
             extend this with more things.
             '''
-        self._screen.resize(rows, cols)
+        self._terminal.resize(rows, cols)
         self.interpreter.setwinsize(rows, cols)
 
     @staticmethod
-    def _universal_new_lines(out):
-        return '\n'.join(out.splitlines())
+    def _pieces_by_chunk(chunks):
+        ''' Iterate over the pieces of each chunk: <chunks> is an
+            OutputSink (see OutputSink.pieces_by_chunk) or any iterable
+            of strings, each one a single piece. '''
+        if isinstance(chunks, OutputSink):
+            return chunks.pieces_by_chunk()
+        return ((chunk, ) for chunk in chunks)
 
     def _emulate_ansi_terminal(self, chunks, join=True):
-        for chunk in chunks:
-            self._stream.feed(chunk)
-
-        lines = self._screen.display
-        self._screen.reset()
+        for pieces in self._pieces_by_chunk(chunks):
+            for piece in pieces:
+                # without a terminal nobody translates the \n to \r\n
+                if self._transport == 'pipe':
+                    piece = piece.replace('\n', '\r\n')
+                self._terminal.feed(piece)
+
+        lines = self._terminal.display()
         if str == bytes:
             # Python 2.7 support only: it works on str/bytes only
             # XXX this is a limitation, if the output has a single non-ascii
             # character this will blow up without the 'ignore'
-            lines = (str(line.rstrip().encode('ascii', 'ignore')) for line in lines)
-        else:
-            lines = (line.rstrip() for line in lines)
+            lines = (str(line.encode('ascii', 'ignore')) for line in lines)
 
         return '\n'.join(lines) if join else lines
 
-    def _emulate_dumb_terminal(self, chunks):
-        chunks = (self._universal_new_lines(chunk) for chunk in chunks)
-        chunks = (chunk.expandtabs(8) for chunk in chunks)
+    def _normalize_lines(self, chunks, expand_tabs, rstrip):
+        normalizer = _LineNormalizer(expand_tabs, rstrip)
+        for pieces in self._pieces_by_chunk(chunks):
+            for piece in pieces:
+                normalizer.feed(piece)
 
-        # remove trailing space from each line
-        lines_group = (chunk.split('\n') for chunk in chunks)
-        chunks = ('\n'.join(l.rstrip() for l in lines) for lines in lines_group)
+        return normalizer.close()
 
-        return ''.join(chunks)
+    def _emulate_dumb_terminal(self, chunks):
+        return self._normalize_lines(chunks, expand_tabs=True, rstrip=True)
 
     def _emulate_as_is_terminal(self, chunks):
-        return ''.join((self._universal_new_lines(chunk) for chunk in chunks))
+        return self._normalize_lines(chunks, expand_tabs=False, rstrip=False)
 
     def _expect_prompt(self, options, timeout, prompt_re=None):
         ''' Wait for a <prompt_re> (any self.any_PS_re if <prompt_re> is None)
@@ -321,11 +1125,11 @@ class PexepctMixin(object):
         PS_found, Timeout = range(len(expect))
 
         what = self.interpreter.expect(expect, timeout=timeout)
-        self.last_output.append(self.interpreter.before)
+        self._consume_before()
 
         if what == Timeout:
             msg = "Prompt not found: the code is taking too long to finish or there is a syntax error.\nLast 1000 bytes read:\n%s"
-            msg = msg % ''.join(self.last_output)[-1000:]
+            msg = msg % self.last_output.tail(1000)
             out = self._get_output(options)
             raise TimeoutException(msg, out)
 
@@ -399,14 +1203,27 @@ class PexepctMixin(object):
             raise
 
     def _abort(self, example, options):
+        if self._in_flight:
+            # the examples already sent will be executed anyways
+            # so we cannot get back the control of the interpreter
+            self._in_flight.clear()
+            return False
+
         self.interpreter.sendcontrol('c')
 
         try:
-            # wait for the prompt, ignore any extra output
-            self._expect_prompt(
-                    options,
-                    timeout=options['x']['dfl_timeout'],
-                    prompt_re=self.PS1_re)
+            # wait for the prompt, ignore any extra output; if the
+            # example was framed, the code that prints the nonce may or
+            # may not be discarded with the ctrl-c so we send a new one
+            # and we wait for it
+            if self._pending_nonce is not None:
+                self.interpreter.send(self._new_frame(options))
+                self._expect_nonce(options, options['x']['dfl_timeout'])
+            else:
+                self._expect_prompt(
+                        options,
+                        timeout=options['x']['dfl_timeout'],
+                        prompt_re=self.PS1_re)
             self._drop_output()
             return True
         except TimeoutException as ex:
@@ -0,0 +1,137 @@
+from __future__ import unicode_literals
+import io, re
+from .common import log
+
+class Shard(object):
+    r'''
+    A piece of a file: the lines from <start_lineno> to <end_lineno>
+    (both inclusive) of <filepath>.
+
+    Each shard is processed by its own job with its own runners so
+    the state of an interpreter is never shared between two shards.
+
+        >>> from byexample.shard import Shard
+        >>> shard = Shard('foo.md', 1, 10, 0, 2, size=123)
+        >>> str(shard)
+        'foo.md:1-10'
+
+        >>> shard.contains(10), shard.contains(11)
+        (True, False)
+    '''
+    def __init__(self, filepath, start_lineno, end_lineno, nro, total, size=0):
+        self.filepath = filepath
+        self.start_lineno = start_lineno
+        self.end_lineno = end_lineno
+        self.nro = nro
+        self.total = total
+        self.size = size
+
+    def contains(self, lineno):
+        return self.start_lineno <= lineno <= self.end_lineno
+
+    def __str__(self):
+        return '%s:%i-%i' % (self.filepath, self.start_lineno, self.end_lineno)
+
+    def __repr__(self):
+        return 'Shard %s (%i/%i)' % (str(self), self.nro + 1, self.total)
+
+def split_in_shards(filepath, string, boundary_re):
+    r'''
+    Split the <string> (the content of <filepath>) in shards: a new
+    shard begins at each line that matches <boundary_re>.
+
+        >>> from byexample.shard import split_in_shards
+        >>> string = 'intro\n## Foo\n>>> 1\n1\n## Bar\n>>> 2\n2\n'
+
+        >>> split_in_shards('foo.md', string, r'^## ')
+        [Shard foo.md:1-1 (1/3), Shard foo.md:2-4 (2/3), Shard foo.md:5-7 (3/3)]
+
+    If there is no boundary, the whole file is a single shard:
+
+        >>> split_in_shards('foo.md', string, r'^### ')
+        [Shard foo.md:1-7 (1/1)]
+    '''
+    lines = string.splitlines(True)
+    boundary_re = re.compile(boundary_re)
+
+    starts = [0] + [i for i, line in enumerate(lines)
+                            if i > 0 and boundary_re.search(line)]
+    ends = starts[1:] + [len(lines)]
+
+    total = len(starts)
+    return [Shard(filepath, start + 1, max(end, start + 1), nro, total,
+                    size=sum(len(line) for line in lines[start:end]))
+                for nro, (start, end) in enumerate(zip(starts, ends))]
+
+def shard_files(testfiles, boundary_re, encoding, verbosity):
+    ''' Split each file in <testfiles> in shards (see split_in_shards).
+
+        Files that do not have any boundary are not split: they are
+        returned as they are.
+        '''
+    items = []
+    for filepath in testfiles:
+        with io.open(filepath, 'rt', encoding=encoding) as f:
+            shards = split_in_shards(filepath, f.read(), boundary_re)
+
+        if len(shards) > 1:
+            log("File '%s': %i shards" % (filepath, len(shards)), verbosity-2)
+            items.extend(shards)
+        else:
+            items.append(filepath)
+
+    return items
+
+class ShardReport(object):
+    ''' Merge the results of the shards of each file and print
+        a summary per file once all of its shards were processed.
+        '''
+    def __init__(self, verbosity, quiet):
+        self.verbosity = verbosity
+        self.quiet = quiet
+        self.results = {}
+
+    def record(self, item, elapsed, result, complete=True):
+        if not isinstance(item, Shard):
+            return
+
+        results = self.results.setdefault(item.filepath, [])
+        results.append((item, elapsed, result))
+
+        if len(results) == item.total:
+            self._report(item.filepath, results)
+            del self.results[item.filepath]
+
+    def finish(self):
+        ''' Report the files that had some of their shards not
+            processed (because the execution was cancelled). '''
+        for filepath, results in sorted(self.results.items()):
+            self._report(filepath, results)
+        self.results.clear()
+
+    def _report(self, filepath, results):
+        if self.quiet:
+            return
+
+        total = results[0][0].total
+        elapsed = sum(r[1] for r in results)
+
+        passed = failed = aborted = 0
+        for _, _, (fail, abort, user_aborted, error) in results:
+            if abort or user_aborted or error:
+                aborted += 1
+            elif fail:
+                failed += 1
+            else:
+                passed += 1
+
+        if aborted or len(results) < total:
+            status_str = "[ABORT]"
+        elif failed:
+            status_str = "[FAIL]"
+        else:
+            status_str = "[PASS]"
+
+        log("\nFile %s, %i/%i shards ran in %0.2f seconds\n%s Shards passed: %i failed: %i aborted: %i" % (
+                    filepath, len(results), total, elapsed,
+                    status_str, passed, failed, aborted), self.verbosity)
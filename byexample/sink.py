@@ -0,0 +1,158 @@
+from __future__ import unicode_literals
+import io, os, tempfile
+
+class OutputSink(object):
+    r'''
+    Collect the output of an example: the chunks of text read from the
+    interpreter.
+
+    The chunks are kept in memory but once they take more than
+    <spill_threshold> characters they are moved to a temporary file
+    and the next chunks are appended there.
+
+        >>> from byexample.sink import OutputSink
+        >>> sink = OutputSink(spill_threshold=8)
+
+        >>> sink.append('abc\r\n')
+        >>> sink.spilled
+        False
+
+        >>> sink.append('de\tf  \r\nghi')
+        >>> sink.spilled
+        True
+
+    The chunks can be read back whole, like if the sink were a list:
+
+        >>> list(sink)
+        ['abc\r\n', 'de\tf  \r\nghi']
+
+    Or by pieces, without loading a whole chunk in memory: once spilled,
+    each piece is a line of the chunk (or what is left of the chunk):
+
+        >>> [list(pieces) for pieces in sink.pieces_by_chunk()]
+        [['abc\r\n'], ['de\tf  \r\n', 'ghi']]
+
+    A tail of the output is always kept in memory:
+
+        >>> len(sink), sink.tail(5)
+        (16, '\r\nghi')
+
+    The chunks can be joined removing something from them, getting
+    a new sink:
+
+        >>> import re
+        >>> list(sink.sub(re.compile(r'\s+'), ''))
+        ['abcdefghi']
+
+    Close the sink to remove the temporary file:
+
+        >>> sink.close()
+    '''
+    def __init__(self, spill_threshold, tail_size=1000):
+        self.spill_threshold = spill_threshold
+        self.tail_size = tail_size
+
+        self._chunks = []
+        self._lengths = []
+        self._size = 0
+        self._tail = ''
+        self._file = None
+
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    def append(self, chunk):
+        self._size += len(chunk)
+        self._tail = (self._tail + chunk[-self.tail_size:])[-self.tail_size:]
+
+        if self._file is None:
+            self._chunks.append(chunk)
+            if self.spill_threshold and self._size > self.spill_threshold:
+                self._spill()
+        else:
+            self._file.write(chunk)
+            self._lengths.append(len(chunk))
+
+    def _spill(self):
+        fd, path = tempfile.mkstemp(prefix='byexample-output-')
+        try:
+            self._file = io.open(fd, 'w+', encoding='utf-8', newline='')
+        finally:
+            os.remove(path)
+
+        for chunk in self._chunks:
+            self._file.write(chunk)
+            self._lengths.append(len(chunk))
+
+        del self._chunks[:]
+
+    def pieces_by_chunk(self):
+        ''' Yield, for each chunk, an iterable of its pieces.
+
+            In memory a chunk is a single piece; once spilled, each
+            piece is a line of the chunk (with its line terminator) so
+            only a line is in memory at a time.
+            '''
+        if self._file is None:
+            for chunk in self._chunks:
+                yield (chunk, )
+            return
+
+        self._file.flush()
+        self._file.seek(0)
+        for length in self._lengths:
+            yield self._read_pieces(length)
+
+    def _read_pieces(self, remain):
+        while remain > 0:
+            piece = self._file.readline(remain)
+            if not piece:
+                break   # pragma: no cover
+
+            remain -= len(piece)
+            yield piece
+
+    def __iter__(self):
+        for pieces in self.pieces_by_chunk():
+            yield ''.join(pieces)
+
+    def __len__(self):
+        return self._size
+
+    def tail(self, n):
+        ''' Return the last <n> characters (up to tail_size). '''
+        return self._tail[-n:]
+
+    def sub(self, regex, repl):
+        ''' Return a new sink with all the chunks joined and with the
+            matches of <regex> replaced by <repl>.
+
+            The <regex> is applied to each piece (see pieces_by_chunk)
+            so it must not match across lines.
+            '''
+        sink = OutputSink(self.spill_threshold, self.tail_size)
+        if self._file is None:
+            sink.append(regex.sub(repl, ''.join(self._chunks)))
+            return sink
+
+        # the new sink may spill on its own but in any case, all the
+        # pieces appended are a single chunk
+        pieces = (regex.sub(repl, piece)
+                    for pieces in self.pieces_by_chunk() for piece in pieces)
+        for piece in pieces:
+            sink.append(piece)
+
+        if sink._file is None:
+            sink._chunks = [''.join(sink._chunks)]
+        else:
+            sink._lengths = [sum(sink._lengths)]
+        return sink
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        del self._chunks[:]
+        del self._lengths[:]
@@ -0,0 +1,234 @@
+'''
+Benchmarks of the runners.
+
+Run them from the root of the project, like:
+
+    $ python test/bench.py output 10M 100M 1G
+
+ - output: push the given amounts of output through a local sh runner
+   and report how long it took to get it (the prompt search included),
+   connected by a pty and by pipes (see +transport).
+
+ - normalize: normalize the given amounts of output as the dumb and as-is
+   terminals do, comparing with the previous implementation (a chain of
+   passes over each chunk).
+
+ - ansi: emulate an ANSI terminal for the given amounts of output with
+   and without colors, comparing with the previous implementation (a
+   pyte screen without history for all the output).
+
+ - startup: start and shutdown a Python runner the given amount of times,
+   like for that many files, spawning a new interpreter each time and
+   forking it from a template (see +py-zygote), with and without
+   preloading some modules (see +py-preload).
+
+ - python: run the given amount of tiny examples in a Python runner
+   driving the interactive interpreter through a pty and sending them
+   to the driver loop through pipes (see +py-backend).
+'''
+from __future__ import unicode_literals, print_function
+import sys, os, time, resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from byexample.options import Options
+from byexample.modules.shell import ShellInterpreter
+from byexample.modules.python import PythonInterpreter
+from byexample.runner import _LineNormalizer, _AnsiTerminal
+from pyte import Stream, Screen
+
+_units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+def parse_size(size):
+    if size[-1].upper() in _units:
+        return int(size[:-1]) * _units[size[-1].upper()]
+    return int(size)
+
+def default_options(**kw):
+    options = Options({
+            'timeout': 600,
+            'geometry': (24, 80),
+            'term': 'as-is',
+            'transport': 'pty',
+            'block': False,
+            'frame': False,
+            'shebangs': {},
+            'stop_on_timeout': False,
+            'stop_on_silence': False,
+            'x': {
+                'dfl_timeout': 10,
+                'delaybeforesend': None,
+                'spill_output': 64,
+                },
+            })
+    options.up(kw)
+    return options
+
+def bench_output(sizes, term='as-is', transport='pty'):
+    ''' Push <sizes> bytes of output, in lines of 79 characters,
+        through a local sh runner. '''
+    options = default_options(term=term, transport=transport)
+    runner = ShellInterpreter(verbosity=0, encoding='utf-8')
+    runner.initialize(options)
+    try:
+        for size in sizes:
+            nbytes = parse_size(size)
+            source = "head -c %i /dev/zero | tr '\\0' 'a' | fold -w 79\n" % nbytes
+
+            begin = time.time()
+            out = runner._exec_and_wait(source, options)
+            elapsed = time.time() - begin
+
+            assert len(out) >= nbytes, (len(out), nbytes)
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            print("output %6s %4s: %8.2f seconds %8.2f MB/s (max RSS %i MB)" % (
+                        size, transport, elapsed, nbytes / elapsed / (1 << 20), rss // 1024))
+            del out
+    finally:
+        runner.shutdown()
+
+def _chained_dumb(chunks):
+    chunks = ('\n'.join(chunk.splitlines()) for chunk in chunks)
+    chunks = (chunk.expandtabs(8) for chunk in chunks)
+    lines_group = (chunk.split('\n') for chunk in chunks)
+    chunks = ('\n'.join(l.rstrip() for l in lines) for lines in lines_group)
+    return ''.join(chunks)
+
+def _chained_as_is(chunks):
+    return ''.join('\n'.join(chunk.splitlines()) for chunk in chunks)
+
+def _single_pass(expand_tabs, rstrip):
+    def normalize(chunks):
+        normalizer = _LineNormalizer(expand_tabs, rstrip)
+        for chunk in chunks:
+            normalizer.feed(chunk)
+        return normalizer.close()
+    return normalize
+
+def bench_normalize(sizes, chunk_size=4096):
+    ''' Normalize <sizes> characters of output, with tabs, trailing
+        whitespace and \r\n, in chunks of <chunk_size> characters. '''
+    line = 'key\tvalue  \t some more text in this line    \r\n'
+    impls = [
+            ('dumb  chained', _chained_dumb),
+            ('dumb  single ', _single_pass(True, True)),
+            ('as-is chained', _chained_as_is),
+            ('as-is single ', _single_pass(False, False)),
+            ]
+    for size in sizes:
+        nchars = parse_size(size)
+        text = line * (nchars // len(line))
+        chunks = [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
+        for name, impl in impls:
+            begin = time.time()
+            impl(chunks)
+            elapsed = time.time() - begin
+            print("normalize %6s %s: %8.2f seconds %8.2f MB/s" % (
+                        size, name, elapsed, nchars / elapsed / (1 << 20)))
+
+def _pyte_screen(rows, cols):
+    def emulate(chunks):
+        screen = Screen(cols, rows)
+        stream = Stream(screen)
+        for chunk in chunks:
+            stream.feed(chunk)
+        return [line.rstrip() for line in screen.display]
+    return emulate
+
+def _ansi_terminal(rows, cols):
+    def emulate(chunks):
+        terminal = _AnsiTerminal(rows, cols, history=10000)
+        for chunk in chunks:
+            terminal.feed(chunk)
+        return terminal.display()
+    return emulate
+
+def bench_ansi(sizes, chunk_size=4096, rows=24, cols=80):
+    ''' Emulate an ANSI terminal for <sizes> characters of output
+        in chunks of <chunk_size> characters: plain text, colored text
+        and text that erases the end of each line (not a color). '''
+    workloads = [
+            ('plain  ', 'some text in this line, nothing else\r\n'),
+            ('colored', '\x1b[31msome text\x1b[0m in \x1b[1;32mthis line\x1b[0m\r\n'),
+            ('erase  ', 'some text in this line, erase the rest\x1b[K\r\n'),
+            ]
+    impls = [
+            ('screen  ', _pyte_screen(rows, cols)),
+            ('terminal', _ansi_terminal(rows, cols)),
+            ]
+    for size in sizes:
+        nchars = parse_size(size)
+        for wname, line in workloads:
+            text = line * (nchars // len(line))
+            chunks = [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
+            for name, impl in impls:
+                begin = time.time()
+                impl(chunks)
+                elapsed = time.time() - begin
+                print("ansi %6s %s %s: %8.2f seconds %8.2f MB/s" % (
+                            size, wname, name, elapsed, nchars / elapsed / (1 << 20)))
+
+def bench_startup(counts, preload=('json', 'decimal', 'fractions')):
+    ''' Start a Python runner and run a trivial example, then shut it
+        down, <counts> times. '''
+    for count in counts:
+        count = int(count)
+        for zygote in (False, True):
+            for modules in ((), preload):
+                options = default_options(py_doctest=False, py_pretty_print=True,
+                                          py_zygote=zygote, py_preload=list(modules),
+                                          py_backend='repl')
+                runner = PythonInterpreter(verbosity=0, encoding='utf-8')
+                begin = time.time()
+                for _ in range(count):
+                    runner.initialize(options)
+                    runner._exec_and_wait('1 + 1\n', options)
+                    runner.shutdown()
+                elapsed = time.time() - begin
+
+                if runner._zygote:
+                    runner._shutdown_zygote()
+
+                print("startup %5i %-6s %-7s: %8.2f seconds %8.2f ms per file" % (
+                            count, 'zygote' if zygote else 'spawn',
+                            'preload' if modules else '',
+                            elapsed, elapsed * 1000 / count))
+
+def bench_python(counts):
+    ''' Run <counts> examples like "1 + 1" in a Python runner. '''
+    for count in counts:
+        count = int(count)
+        for backend in ('repl', 'driver'):
+            options = default_options(py_doctest=False, py_pretty_print=True,
+                                      py_zygote=False, py_preload=[],
+                                      py_backend=backend)
+            runner = PythonInterpreter(verbosity=0, encoding='utf-8')
+            runner.initialize(options)
+            try:
+                begin = time.time()
+                for i in range(count):
+                    out = runner._exec_and_wait('%i + 1' % i, options)
+                    assert out == str(i + 1), (out, i)
+                elapsed = time.time() - begin
+            finally:
+                runner.shutdown()
+
+            print("python %6i %-6s: %8.2f seconds %8.2f ms per example" % (
+                        count, backend, elapsed, elapsed * 1000 / count))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ('output', 'normalize', 'ansi', 'startup', 'python'):
+        print(__doc__)
+        sys.exit(1)
+
+    what, args = sys.argv[1], sys.argv[2:]
+    if what == 'output':
+        for transport in ('pty', 'pipe'):
+            bench_output(args or ['10M', '100M'], transport=transport)
+    elif what == 'normalize':
+        bench_normalize(args or ['10M', '100M'])
+    elif what == 'ansi':
+        bench_ansi(args or ['1M'])
+    elif what == 'startup':
+        bench_startup(args or ['20'])
+    elif what == 'python':
+        bench_python(args or ['1000'])